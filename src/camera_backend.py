@@ -0,0 +1,290 @@
+import io
+import time
+import zlib
+import struct
+import logging
+import argparse
+from abc import ABC, abstractmethod
+from timeit import default_timer as timer
+
+logger = logging.getLogger("rr_drive")
+
+
+def parse_resolution(value):
+    if isinstance(value, str):
+        value = value.lower().split("x")
+    width, height = value
+    return int(width), int(height)
+
+
+class CameraBackend(ABC):
+    """Camera used by the controller, the device is opened on first use
+
+    Settings applied before the device is open are kept and pushed to the
+    device when it is opened, so creating a backend never touches hardware.
+    """
+
+    name = "none"
+
+    def __init__(self, resolution=(1024, 768), framerate: int = 15) -> None:
+        self._resolution = parse_resolution(resolution)
+        self._framerate = framerate
+        self.is_open = False
+
+    @abstractmethod
+    def _open(self):
+        pass
+
+    def _apply_settings(self):
+        pass
+
+    def _close(self):
+        pass
+
+    def ensure_open(self):
+        if not self.is_open:
+            start = timer()
+            self._open()
+            self.is_open = True
+            self._apply_settings()
+            logger.info(f"Opened {self.name} camera in {timer() - start:.2f}s")
+
+    def close(self):
+        if self.is_open:
+            self._close()
+            self.is_open = False
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    @resolution.setter
+    def resolution(self, value):
+        self._resolution = parse_resolution(value)
+        if self.is_open:
+            self._apply_settings()
+
+    @property
+    def framerate(self):
+        return self._framerate
+
+    @framerate.setter
+    def framerate(self, value):
+        self._framerate = value
+        if self.is_open:
+            self._apply_settings()
+
+    def start_preview(self):
+        self.ensure_open()
+
+    def stop_preview(self):
+        pass
+
+    @abstractmethod
+    def capture(self, output, format=None, use_video_port=False, **options):
+        pass
+
+    def lock_exposure(self) -> str:
+        """Freezes exposure and white balance, returns a description of them"""
+        return ""
+
+    def unlock_exposure(self):
+        pass
+
+
+class PiCameraBackend(CameraBackend):
+    name = "picamera"
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self._device = None
+
+    def _open(self):
+        from picamera import PiCamera
+
+        self._device = PiCamera()
+
+    def _apply_settings(self):
+        self._device.framerate = self._framerate
+        self._device.resolution = self._resolution
+
+    def _close(self):
+        self._device.close()
+        self._device = None
+
+    def start_preview(self):
+        self.ensure_open()
+        self._device.start_preview()
+
+    def stop_preview(self):
+        if self.is_open:
+            self._device.stop_preview()
+
+    def capture(self, output, format=None, use_video_port=False, **options):
+        self.ensure_open()
+        self._device.capture(
+            output, format=format, use_video_port=use_video_port, **options
+        )
+
+    def lock_exposure(self) -> str:
+        self.ensure_open()
+        self._device.shutter_speed = self._device.exposure_speed
+        self._device.exposure_mode = "off"
+        gains = self._device.awb_gains
+        self._device.awb_mode = "off"
+        self._device.awb_gains = gains
+        return f"shutter: {self._device.shutter_speed}, awb gains: {gains}"
+
+    def unlock_exposure(self):
+        if self.is_open:
+            self._device.shutter_speed = 0
+            self._device.exposure_mode = "auto"
+            self._device.awb_mode = "auto"
+
+
+class SyntheticCameraBackend(CameraBackend):
+    """Produces deterministic frames after a configurable latency
+
+    Frame n is a diagonal gradient shifted by n, raw frames are padded like
+    PiCamera's. Used to run and benchmark the controller without a Pi camera.
+    """
+
+    name = "synthetic"
+
+    def __init__(self, latency: float = 0.2, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.frame_index = 0
+
+    def _open(self):
+        self.frame_index = 0
+
+    def _rows(self, width, height, channels):
+        base = bytes(i % 251 for i in range(width * channels + 251))
+        line = width * channels
+        for y in range(height):
+            k = (y + self.frame_index) % 251
+            yield base[k : k + line]
+
+    def _raw(self, channels):
+        width, height = self._resolution
+        padded_width = (width + 31) // 32 * 32
+        padded_height = (height + 15) // 16 * 16
+        return b"".join(self._rows(padded_width, padded_height, channels))
+
+    def _png(self):
+        width, height = self._resolution
+        raw = b"".join(b"\x00" + row for row in self._rows(width, height, 3))
+
+        def chunk(kind, data):
+            return (
+                struct.pack(">I", len(data))
+                + kind
+                + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+            )
+
+        return b"".join(
+            [
+                b"\x89PNG\r\n\x1a\n",
+                chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)),
+                chunk(b"IDAT", zlib.compress(raw, 6)),
+                chunk(b"IEND", b""),
+            ]
+        )
+
+    def _bmp(self):
+        width, height = self._resolution
+        padding = b"\x00" * ((4 - (width * 3) % 4) % 4)
+        rows = list(self._rows(width, height, 3))
+        pixels = b"".join(row + padding for row in reversed(rows))
+        header = struct.pack(
+            "<IiiHHIIiiII", 40, width, height, 1, 24, 0, len(pixels), 2835, 2835, 0, 0
+        )
+        return (
+            b"BM" + struct.pack("<IHHI", 14 + len(header) + len(pixels), 0, 0, 54)
+        ) + header + pixels
+
+    def _jpeg(self, quality=85):
+        from PIL import Image
+
+        width, height = self._resolution
+        image = Image.frombytes(
+            "RGB", (width, height), b"".join(self._rows(width, height, 3))
+        )
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality)
+        return buffer.getvalue()
+
+    def capture(self, output, format=None, use_video_port=False, **options):
+        self.ensure_open()
+        if format is None and isinstance(output, str):
+            format = output.rsplit(".", 1)[-1].lower().replace("jpg", "jpeg")
+        time.sleep(self.latency)
+        if format in ["rgb", "bgr"]:
+            data = self._raw(channels=3)
+        elif format in ["rgba", "bgra"]:
+            data = self._raw(channels=4)
+        elif format == "yuv":
+            data = self._raw(channels=1)
+            data = data + data[: len(data) // 2]
+        elif format == "bmp":
+            data = self._bmp()
+        elif format == "jpeg":
+            data = self._jpeg(quality=options.get("quality", 85))
+        else:
+            data = self._png()
+        self.frame_index += 1
+        if isinstance(output, str):
+            with open(output, "wb") as f:
+                f.write(data)
+        else:
+            output.write(data)
+
+    def lock_exposure(self) -> str:
+        return "synthetic"
+
+
+CAMERA_BACKENDS = {
+    PiCameraBackend.name: PiCameraBackend,
+    SyntheticCameraBackend.name: SyntheticCameraBackend,
+}
+
+
+def create_camera(settings: dict) -> CameraBackend:
+    """Builds the backend selected in settings without opening it"""
+    name = settings.get("camera_backend", PiCameraBackend.name)
+    if name not in CAMERA_BACKENDS:
+        logger.error(f"Unknown camera backend {name}, using {PiCameraBackend.name}")
+        name = PiCameraBackend.name
+    kwargs = {}
+    if name == SyntheticCameraBackend.name:
+        kwargs["latency"] = settings.get("synthetic_latency", 0.2)
+    return CAMERA_BACKENDS[name](**kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark camera capture")
+    parser.add_argument("--backend", default=SyntheticCameraBackend.name)
+    parser.add_argument("--resolution", default="2592x1944")
+    parser.add_argument("--format", default="png")
+    parser.add_argument("--count", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    camera = create_camera(
+        {"camera_backend": args.backend, "synthetic_latency": args.latency}
+    )
+    camera.resolution = args.resolution
+    start = timer()
+    camera.start_preview()
+    print(f"Open and preview: {timer() - start:.3f}s")
+    start = timer()
+    for _ in range(args.count):
+        camera.capture(io.BytesIO(), format=args.format)
+    elapsed = timer() - start
+    camera.stop_preview()
+    camera.close()
+    print(
+        f"{args.count} {args.format} captures in {elapsed:.3f}s, {args.count / elapsed:.2f}/s"
+    )
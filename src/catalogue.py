@@ -0,0 +1,292 @@
+import os
+import sys
+import csv
+import json
+import glob
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+from datetime import datetime as dt
+
+logger = logging.getLogger("rr_drive")
+
+images_folder = os.path.join(os.path.dirname(__file__), "..", "data", "images")
+catalogue_path = os.path.join(images_folder, "catalogue.db")
+# Job tags written before the catalogue existed, imported by the backfill
+capture_jobs_path = os.path.join(images_folder, "capture_jobs.csv")
+
+UPLOAD_PENDING = "pending"
+UPLOAD_SENT = "sent"
+UPLOAD_USB = "usb"
+UPLOAD_KEPT = "kept"
+UPLOAD_MISSING = "missing"
+
+IMAGE_FOLDERS = ["to_send", "to_keep", "sent"]
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_name TEXT NOT NULL UNIQUE,
+    folder TEXT NOT NULL,
+    experiment TEXT,
+    plant_name TEXT,
+    position INTEGER,
+    job_guids TEXT NOT NULL DEFAULT '',
+    job_names TEXT NOT NULL DEFAULT '',
+    captured_at TEXT NOT NULL,
+    size INTEGER,
+    sha256 TEXT,
+    camera TEXT NOT NULL DEFAULT '{}',
+    upload_state TEXT NOT NULL,
+    uploaded_at TEXT
+);
+CREATE INDEX IF NOT EXISTS captures_plant
+    ON captures (experiment, plant_name, captured_at);
+CREATE INDEX IF NOT EXISTS captures_time ON captures (captured_at);
+CREATE INDEX IF NOT EXISTS captures_upload ON captures (upload_state, captured_at);
+"""
+
+COLUMNS = [
+    "file_name",
+    "folder",
+    "experiment",
+    "plant_name",
+    "position",
+    "job_guids",
+    "job_names",
+    "captured_at",
+    "size",
+    "sha256",
+    "camera",
+    "upload_state",
+    "uploaded_at",
+]
+
+
+def file_sha256(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_file_name(file_name) -> dict:
+    """Reads experiment, plant, position and time from rr#exp#plant#pos#time.ext"""
+    parts = os.path.splitext(file_name)[0].split("#")
+    entry = {"experiment": None, "plant_name": None, "position": None}
+    if len(parts) == 5:
+        entry["experiment"], entry["plant_name"] = parts[1], parts[2]
+        try:
+            entry["position"] = int(parts[3])
+        except ValueError:
+            pass
+    try:
+        entry["captured_at"] = dt.strptime(parts[-1], "%Y%m%d_%H%M%S")
+    except ValueError:
+        entry["captured_at"] = None
+    return entry
+
+
+class CaptureCatalogue:
+    """SQLite index of every image taken, shared by the UI and the upload tools
+
+    Entries are indexed by experiment and plant, by time and by upload state.
+    The database is in WAL mode so that the UI and send_images.py can write to
+    it at the same time.
+    """
+
+    def __init__(self, path=catalogue_path) -> None:
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self._connection = connection
+            if connection.execute("PRAGMA user_version").fetchone()[0] == 0:
+                added = self.backfill()
+                connection.execute("PRAGMA user_version = 1")
+                logger.info(f"Capture catalogue created, {added} existing images added")
+        return self._connection
+
+    def _execute(self, query, params=()):
+        with self._lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def add(self, path, entry: dict, folder: str = None):
+        """Adds a stored capture, entry holds what was known when it was taken"""
+        folder = folder or os.path.basename(os.path.dirname(path))
+        captured_at = entry.get("captured_at") or dt.now()
+        row = {
+            "file_name": os.path.basename(path),
+            "folder": folder,
+            "experiment": entry.get("experiment"),
+            "plant_name": entry.get("plant_name"),
+            "position": entry.get("position"),
+            "job_guids": entry.get("job_guids", ""),
+            "job_names": entry.get("job_names", ""),
+            "captured_at": captured_at.strftime(TIME_FORMAT),
+            "size": os.path.getsize(path),
+            "sha256": file_sha256(path),
+            "camera": json.dumps(entry.get("camera", {})),
+            "upload_state": UPLOAD_PENDING if folder == "to_send" else UPLOAD_KEPT,
+            "uploaded_at": None,
+        }
+        self._execute(
+            f"INSERT OR REPLACE INTO captures ({', '.join(COLUMNS)})"
+            f" VALUES ({', '.join(':' + c for c in COLUMNS)})",
+            row,
+        )
+
+    def set_upload_state(self, file_name, state: str, folder: str = None):
+        uploaded_at = None
+        if state in [UPLOAD_SENT, UPLOAD_USB]:
+            uploaded_at = dt.now().strftime(TIME_FORMAT)
+        self._execute(
+            "UPDATE captures SET upload_state = ?, uploaded_at = ?,"
+            " folder = COALESCE(?, folder) WHERE file_name = ?",
+            (state, uploaded_at, folder, file_name),
+        )
+
+    def pending(self, limit: int = -1) -> list:
+        """File names waiting to be sent, oldest first"""
+        return [
+            name
+            for name, in self._execute(
+                "SELECT file_name FROM captures WHERE upload_state = ?"
+                " ORDER BY captured_at LIMIT ?",
+                (UPLOAD_PENDING, limit),
+            )
+        ]
+
+    def oldest_pending(self):
+        rows = self._execute(
+            "SELECT MIN(captured_at) FROM captures WHERE upload_state = ?",
+            (UPLOAD_PENDING,),
+        )
+        return dt.strptime(rows[0][0], TIME_FORMAT) if rows and rows[0][0] else None
+
+    def find(
+        self, experiment=None, plant_name=None, start=None, end=None, state=None
+    ) -> list:
+        """Returns the matching entries as dicts, oldest first"""
+        conditions, params = [], []
+        for column, value in [
+            ("experiment", experiment),
+            ("plant_name", plant_name),
+            ("upload_state", state),
+        ]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if start is not None:
+            conditions.append("captured_at >= ?")
+            params.append(start.strftime(TIME_FORMAT))
+        if end is not None:
+            conditions.append("captured_at < ?")
+            params.append(end.strftime(TIME_FORMAT))
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._execute(
+            f"SELECT {', '.join(COLUMNS)} FROM captures{where} ORDER BY captured_at",
+            params,
+        )
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def backfill(self) -> int:
+        """Adds the images already in the image folders, from their names"""
+        jobs = {}
+        if os.path.isfile(capture_jobs_path):
+            with open(capture_jobs_path, "r", newline="") as f:
+                for row in csv.DictReader(f):
+                    jobs[row["file_name"]] = (row["job_guids"], row["job_names"])
+        rows = []
+        for folder in IMAGE_FOLDERS:
+            for path in glob.glob(os.path.join(images_folder, folder, "rr#*")):
+                file_name = os.path.basename(path)
+                entry = parse_file_name(file_name)
+                captured_at = entry["captured_at"] or dt.fromtimestamp(
+                    os.path.getmtime(path)
+                )
+                job_guids, job_names = jobs.get(file_name, ("", ""))
+                rows.append(
+                    (
+                        file_name,
+                        folder,
+                        entry["experiment"],
+                        entry["plant_name"],
+                        entry["position"],
+                        job_guids,
+                        job_names,
+                        captured_at.strftime(TIME_FORMAT),
+                        os.path.getsize(path),
+                        None,
+                        "{}",
+                        {
+                            "to_send": UPLOAD_PENDING,
+                            "to_keep": UPLOAD_KEPT,
+                            "sent": UPLOAD_SENT,
+                        }[folder],
+                        None,
+                    )
+                )
+        self._connection.executemany(
+            f"INSERT OR IGNORE INTO captures ({', '.join(COLUMNS)})"
+            f" VALUES ({', '.join('?' * len(COLUMNS))})",
+            rows,
+        )
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+_shared_catalogue = None
+_shared_lock = threading.Lock()
+
+
+def get_catalogue() -> CaptureCatalogue:
+    """Catalogue shared by all the threads of the process"""
+    global _shared_catalogue
+    with _shared_lock:
+        if _shared_catalogue is None:
+            _shared_catalogue = CaptureCatalogue()
+        return _shared_catalogue
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the capture catalogue")
+    parser.add_argument("--experiment")
+    parser.add_argument("--plant")
+    parser.add_argument("--since", help="YYYY-MM-DD")
+    parser.add_argument("--until", help="YYYY-MM-DD, excluded")
+    parser.add_argument(
+        "--state", choices=[UPLOAD_PENDING, UPLOAD_SENT, UPLOAD_USB, UPLOAD_KEPT]
+    )
+    args = parser.parse_args()
+
+    entries = get_catalogue().find(
+        experiment=args.experiment,
+        plant_name=args.plant,
+        start=dt.strptime(args.since, "%Y-%m-%d") if args.since else None,
+        end=dt.strptime(args.until, "%Y-%m-%d") if args.until else None,
+        state=args.state,
+    )
+    writer = csv.writer(sys.stdout, lineterminator="\n")
+    writer.writerow(COLUMNS)
+    writer.writerows([entry[c] for c in COLUMNS] for entry in entries)
@@ -1,6 +1,9 @@
 import time
 import os
-import json
+import io
+import queue
+import threading
+import csv
 from functools import partial
 import logging
 from datetime import datetime as dt
@@ -11,22 +14,24 @@ import shutil
 from pathlib import Path
 import socket
 import subprocess
-import glob
-from timeit import default_timer as timer
-import paramiko
-
-import pandas as pd
-
-from kivy.network.urlrequest import UrlRequest
-
-from picamera import PiCamera
-
-try:
-    from server_credentials import connection_data
-except Exception as e:
-    server_conf = {}
-else:
-    server_conf = connection_data.get("phenopsis", {})
+from bisect import bisect_left
+from heapq import heappush, heappop, heapify
+from itertools import count
+from collections import namedtuple
+from types import MappingProxyType
+
+from uploader import UploadWorker, send_image, send_pending_images
+from transcoder import (
+    CAPTURE_FORMATS,
+    DEFERRED_FORMATS,
+    Transcoder,
+    pillow_available,
+    remove_orphans,
+)
+from camera_backend import CameraBackend, PiCameraBackend, create_camera
+from state_store import StateStore, read_legacy_files
+from catalogue import get_catalogue
+from upload_scheduler import MIN_UPLOAD_WINDOW, upload_window
 
 logger = logging.getLogger("rr_drive")
 
@@ -42,6 +47,13 @@ plant_data_path = os.path.join(
     "plants_data.csv",
 )
 
+template_datain_path = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "data",
+    "template_datain.csv",
+)
+
 settings_path = os.path.join(
     os.path.dirname(__file__),
     "..",
@@ -56,6 +68,12 @@ if TEST_MODE:
         "test_files",
         "test_jobs.json",
     )
+    state_db_path = os.path.join(
+        os.path.dirname(__file__),
+        "..",
+        "test_files",
+        "test_state.db",
+    )
 else:
     jobs_file_path = os.path.join(
         os.path.dirname(__file__),
@@ -63,6 +81,12 @@ else:
         "data",
         "jobs_data.json",
     )
+    state_db_path = os.path.join(
+        os.path.dirname(__file__),
+        "..",
+        "data",
+        "robot_racine.db",
+    )
 
 
 class JobState(Enum):
@@ -85,6 +109,447 @@ def job_state_to_text(state):
         return "unknown"
 
 
+def parse_hours(value) -> list:
+    if isinstance(value, int):
+        return [value]
+    elif isinstance(value, str):
+        return [int(h) for h in value.replace(" ", "").split(",") if h]
+    elif isinstance(value, list):
+        return [int(h) for h in value]
+    else:
+        return []
+
+
+class Recurrence:
+    """Computes job occurrences arithmetically instead of materializing them
+
+    Occurrences are all the time points of the repetition rule that fall within
+    [start, end[. The last answer of next_after is kept as a cursor so that the
+    countdown, which asks for the next occurrence many times per second, does
+    not have to compute anything until the cursor has been passed.
+    """
+
+    def __init__(self, mode, value, start: dt, end: dt) -> None:
+        self.mode = mode
+        self.start = start
+        self.end = end
+        self.step = None
+        self.hours = []
+        if mode == "every":
+            try:
+                step = td(hours=int(value))
+            except (TypeError, ValueError):
+                step = None
+            if step is not None and step > td(0):
+                self.step = step
+        elif mode == "at":
+            try:
+                self.hours = [
+                    datetime.time(hour=h) for h in sorted(set(parse_hours(value)))
+                ]
+            except (TypeError, ValueError):
+                logger.error(f"Wrong hours for 'at' repetition: {value}")
+                self.hours = []
+        self._cursor = None
+
+    def _compute_next(self, moment: dt):
+        moment = max(moment, self.start)
+        if self.mode == "every":
+            if self.step is None:
+                return None
+            q, r = divmod(moment - self.start, self.step)
+            candidate = self.start + self.step * (q + (1 if r else 0))
+        elif self.mode == "at":
+            if not self.hours:
+                return None
+            day = moment.date()
+            index = bisect_left(self.hours, moment.time())
+            if index < len(self.hours):
+                candidate = dt.combine(date=day, time=self.hours[index])
+            else:
+                candidate = dt.combine(date=day + td(days=1), time=self.hours[0])
+        elif self.mode == "once":
+            candidate = self.start if moment <= self.start else None
+        else:
+            return None
+        return candidate if candidate is not None and candidate < self.end else None
+
+    def next_after(self, moment: dt):
+        """Returns the first occurrence at or after moment, None if there is none"""
+        if self._cursor is not None:
+            asked, answer = self._cursor
+            if asked <= moment and (answer is None or moment <= answer):
+                return answer
+        answer = self._compute_next(moment)
+        self._cursor = (moment, answer)
+        return answer
+
+    def occurrences(self, since: dt = None):
+        """Lazily enumerates occurrences starting at since"""
+        current = self._compute_next(self.start if since is None else since)
+        while current is not None:
+            yield current
+            if self.mode == "every":
+                current = current + self.step
+                if current >= self.end:
+                    current = None
+            else:
+                current = self._compute_next(current + td(microseconds=1))
+
+    def __iter__(self):
+        return self.occurrences()
+
+
+PLANT_DATA_COLUMNS = ["experiment", "plant_name", "position", "allow_capture"]
+
+
+def parse_bool(value) -> bool:
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in ["true", "1", "yes"]:
+            return True
+        elif value in ["false", "0", "no"]:
+            return False
+        raise ValueError(f"{value} is not a boolean")
+    return bool(value)
+
+
+def template_columns() -> list:
+    """Columns of the Data In template, falls back to the plant data columns"""
+    try:
+        with open(template_datain_path, "r", newline="", encoding="utf-8-sig") as f:
+            header = next(csv.reader(f))
+    except (OSError, StopIteration):
+        return list(PLANT_DATA_COLUMNS)
+    return [c.strip() for c in header]
+
+
+class PlantRecord:
+    """One row of the plant data"""
+
+    __slots__ = ("experiment", "plant_name", "position", "allow_capture")
+
+    def __init__(self, experiment, plant_name, position, allow_capture) -> None:
+        self.experiment = experiment
+        self.plant_name = plant_name
+        self.position = position
+        self.allow_capture = allow_capture
+
+    @classmethod
+    def from_row(cls, row: dict):
+        """Builds a record from a csv row, raises ValueError if a field is missing"""
+        values = {k: (row.get(k) or "").strip() for k in PLANT_DATA_COLUMNS}
+        missing = [k for k, v in values.items() if not v]
+        if missing:
+            raise ValueError(f"missing {', '.join(missing)}")
+        try:
+            position = int(float(values["position"]))
+        except ValueError:
+            raise ValueError(f"position {values['position']} is not a number")
+        return cls(
+            experiment=values["experiment"],
+            plant_name=values["plant_name"],
+            position=position,
+            allow_capture=parse_bool(values["allow_capture"]),
+        )
+
+    @property
+    def key(self) -> tuple:
+        return (self.experiment, self.plant_name, self.position, self.allow_capture)
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in PLANT_DATA_COLUMNS}
+
+    def __eq__(self, other):
+        return isinstance(other, PlantRecord) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f"PlantRecord{self.key}"
+
+
+class PlantRegistry:
+    """Plant records indexed by position, experiment and plant name
+
+    Records keep the file order, so the first plant at a position is the one
+    used, as with the previous data frame lookups. Views built for the UI are
+    cached until the records change, version is bumped on every change.
+    """
+
+    def __init__(self, records=()) -> None:
+        self._records = []
+        self._by_position = {}
+        self._by_experiment = {}
+        self._by_name = {}
+        self.version = 0
+        self._views = {}
+        self._views_version = 0
+        self.extend(records)
+
+    def _view(self, key, build):
+        if self._views_version != self.version:
+            self._views = {}
+            self._views_version = self.version
+        if key not in self._views:
+            self._views[key] = build()
+        return self._views[key]
+
+    @classmethod
+    def read_csv(cls, path):
+        """Loads a plant data file, rows with missing or invalid fields are skipped"""
+        registry = cls()
+        with open(path, "r", newline="", encoding="utf-8-sig") as f:
+            for line, row in enumerate(csv.DictReader(f), start=2):
+                try:
+                    record = PlantRecord.from_row(row)
+                except ValueError as e:
+                    logger.warning(f"Skipped line {line} of {path}: {e}")
+                    continue
+                first = registry.at_position(record.position)
+                if first is not None:
+                    logger.warning(
+                        f"Position {record.position} is claimed by {first.plant_name}"
+                        f" and {record.plant_name}, using {first.plant_name}"
+                    )
+                registry.add(record)
+        return registry
+
+    def to_csv(self, path):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(PLANT_DATA_COLUMNS)
+            writer.writerows(record.key for record in self._records)
+
+    def _index(self, record: PlantRecord):
+        self._by_position.setdefault(record.position, []).append(record)
+        self._by_experiment.setdefault(record.experiment, []).append(record)
+        self._by_name.setdefault(record.plant_name, []).append(record)
+
+    def _reindex(self):
+        self._by_position = {}
+        self._by_experiment = {}
+        self._by_name = {}
+        for record in self._records:
+            self._index(record)
+        self.version += 1
+
+    def add(self, record: PlantRecord):
+        self._records.append(record)
+        self._index(record)
+        self.version += 1
+
+    def extend(self, records):
+        for record in records:
+            self.add(record)
+
+    def remove_experiments(self, experiments):
+        experiments = set(experiments)
+        self._records = [r for r in self._records if r.experiment not in experiments]
+        self._reindex()
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def at_position(self, position: int):
+        records = self._by_position.get(position)
+        return records[0] if records else None
+
+    def of_experiment(self, experiment) -> list:
+        return list(self._by_experiment.get(experiment, []))
+
+    def named(self, plant_name) -> list:
+        return list(self._by_name.get(plant_name, []))
+
+    def experiments(self) -> tuple:
+        return self._view("experiments", lambda: tuple(self._by_experiment))
+
+    def plant_names(self, capturable_only: bool = False) -> tuple:
+        if not capturable_only:
+            return self._view("plant_names", lambda: tuple(self._by_name))
+        return self._view(
+            "capturable_plant_names",
+            lambda: tuple(
+                name
+                for name, records in self._by_name.items()
+                if any(r.allow_capture for r in records)
+            ),
+        )
+
+    def plant_names_of(self, experiment) -> tuple:
+        return self._view(
+            ("experiment", experiment),
+            lambda: tuple(
+                r.plant_name for r in self._by_experiment.get(experiment, [])
+            ),
+        )
+
+
+def read_plant_rows(path) -> list:
+    """(experiment, plant_name, position, allow_capture) rows of a plant data file"""
+    return [record.key for record in PlantRegistry.read_csv(path)]
+
+
+class ImportReport:
+    """Outcome of a Data In import"""
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.added = 0
+        self.duplicates = 0
+        self.empty = 0
+        self.bad_rows = []
+        self.conflicts = []
+        self.error = None
+        self.records = []
+
+    @property
+    def issues(self) -> list:
+        return ([self.error] if self.error else []) + self.bad_rows + self.conflicts
+
+    def summary(self) -> str:
+        if self.error:
+            return f"Data In {os.path.basename(self.path)} rejected: {self.error}"
+        return (
+            f"Data In {os.path.basename(self.path)}: {self.added} plants added,"
+            f" {self.duplicates} already known, {self.empty} empty trays,"
+            f" {len(self.bad_rows)} bad rows, {len(self.conflicts)} position conflicts"
+        )
+
+
+def import_plant_data(path, registry: PlantRegistry, tray_count: int = None):
+    """Streams a Data In file into the registry and returns an ImportReport
+
+    Rows are checked against the template columns, rows without experiment and
+    plant name are empty trays. A row is rejected if its position is already
+    taken by another plant, in the registry or earlier in the file. Accepted
+    rows are appended to the registry once the whole file has been read.
+    """
+    report = ImportReport(path)
+    accepted = []
+    claimed = {}
+    with open(path, "r", newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        reader.fieldnames = [c.strip() for c in reader.fieldnames or []]
+        missing = [c for c in template_columns() if c not in reader.fieldnames]
+        if missing:
+            report.error = f"missing columns {', '.join(missing)}"
+            return report
+        for line, row in enumerate(reader, start=2):
+            experiment = (row.get("experiment") or "").strip()
+            if not experiment and not (row.get("plant_name") or "").strip():
+                report.empty += 1
+                continue
+            try:
+                record = PlantRecord.from_row(row)
+            except ValueError as e:
+                report.bad_rows.append(f"Line {line}: {e}")
+                continue
+            if tray_count is not None and not 1 <= record.position <= tray_count:
+                report.bad_rows.append(
+                    f"Line {line}: position {record.position} is not in 1..{tray_count}"
+                )
+                continue
+            owner = claimed.get(record.position) or registry.at_position(
+                record.position
+            )
+            if owner is None:
+                claimed[record.position] = record
+                accepted.append(record)
+            elif owner == record:
+                report.duplicates += 1
+            else:
+                report.conflicts.append(
+                    f"Line {line}: position {record.position} of {record.plant_name}"
+                    f" ({record.experiment}) is taken by {owner.plant_name}"
+                    f" ({owner.experiment})"
+                )
+    registry.extend(accepted)
+    report.records = accepted
+    report.added = len(accepted)
+    return report
+
+
+class IncrementalFilter:
+    """Case insensitive substring filter for type to filter lists
+
+    While the text only grows and the items are the same object, the previous
+    matches are narrowed instead of scanning all the items again.
+    """
+
+    def __init__(self) -> None:
+        self._items = None
+        self._text = ""
+        self._matches = ()
+
+    def __call__(self, items: tuple, text: str) -> tuple:
+        text = text.strip().lower()
+        if not text:
+            matches = items
+        else:
+            if items is self._items and self._text and text.startswith(self._text):
+                source = self._matches
+            else:
+                source = items
+            matches = tuple(i for i in source if text in i.lower())
+        self._items, self._text, self._matches = items, text, matches
+        return matches
+
+
+class TrayAction(Enum):
+    CAPTURE = 0
+    EXCLUDED = 1
+    EMPTY = 2
+    NOT_IN_JOB = 3
+
+
+TrayPlan = namedtuple("TrayPlan", ["plant", "action"])
+
+EMPTY_TRAY = TrayPlan(plant=MappingProxyType({}), action=TrayAction.EMPTY)
+
+
+class JobPlan:
+    """Immutable per tray plan compiled from the plant data before a job starts
+
+    Trays are indexed by position so that the job never touches the plant
+    data while the robot is moving.
+    """
+
+    def __init__(self, trays: tuple) -> None:
+        self._trays = trays
+
+    @classmethod
+    def compile(cls, plants, job_plants, tray_count: int):
+        """Builds the plan from plant records, job_plants None means all plants"""
+        wanted = None if job_plants is None else set(job_plants)
+        trays = [EMPTY_TRAY] * (tray_count + 1)
+        for plant in plants:
+            position = plant.position
+            if not 1 <= position <= tray_count or trays[position] is not EMPTY_TRAY:
+                continue
+            if not plant.allow_capture:
+                action = TrayAction.EXCLUDED
+            elif wanted is not None and plant.plant_name not in wanted:
+                action = TrayAction.NOT_IN_JOB
+            else:
+                action = TrayAction.CAPTURE
+            trays[position] = TrayPlan(plant=MappingProxyType(plant.to_dict()), action=action)
+        return cls(trays=tuple(trays))
+
+    def __getitem__(self, position: int) -> TrayPlan:
+        if 1 <= position < len(self._trays):
+            return self._trays[position]
+        return EMPTY_TRAY
+
+    @property
+    def capture_count(self) -> int:
+        return sum(1 for t in self._trays if t.action == TrayAction.CAPTURE)
+
+
 class JobData:
     def __init__(self, **kwargs) -> None:
         self.name = kwargs.get("name")
@@ -102,7 +567,7 @@ class JobData:
         self._timestamp_end = dt.strptime(
             kwargs.get("timestamp_end"), "%Y/%m/%d %H:%M:%S"
         )
-        self.time_points = []
+        self.recurrence = None
         self.update_time_points()
 
         self.state = JobState.INACTIVE
@@ -122,31 +587,20 @@ class JobData:
             "timestamp_end": self.timestamp_end.strftime("%Y/%m/%d %H:%M:%S"),
         }
 
+    @property
+    def jobs(self) -> list:
+        return [self]
+
+    def owners_of(self, plant_name) -> list:
+        return [self]
+
     def update_time_points(self):
-        self.time_points = []
-        if self.repetition_mode == "every":
-            current = self.timestamp_start
-            while current < self.timestamp_end:
-                self.time_points.append(current)
-                current = current + td(hours=int(self.repetition_value))
-        elif self.repetition_mode == "at":
-            current = self.timestamp_start.date()
-            last = self.timestamp_end.date()
-            if isinstance(self.repetition_value, int):
-                hours = [self.repetition_value]
-            elif isinstance(self.repetition_value, str):
-                hours = [
-                    int(h) for h in self.repetition_value.replace(" ", "").split(",")
-                ]
-            elif isinstance(self.repetition_value, list):
-                hours = self.repetition_value
-            else:
-                hours = []
-            while current < last:
-                self.time_points.extend(
-                    [dt.combine(date=current, time=datetime.time(hour=h)) for h in hours]
-                )
-                current = current + td(days=1)
+        self.recurrence = Recurrence(
+            mode=self.repetition_mode,
+            value=self.repetition_value,
+            start=self.timestamp_start,
+            end=self.timestamp_end,
+        )
 
     def update_time_boundaries(self, start_time, end_time, rep_mode, rep_value):
         if isinstance(start_time, str):
@@ -162,14 +616,20 @@ class JobData:
         self.update_time_points()
 
     @property
-    def next_time_point(self):
+    def time_points(self):
+        """Lazy iterator over all the job's time points"""
+        return iter(self.recurrence)
+
+    def next_time_point_after(self, moment: dt):
         if self.enabled is True:
-            n = dt.now()
-            l = [t for t in self.time_points if t >= n]
-            return l[0] if l else None
+            return self.recurrence.next_after(moment)
         else:
             return None
 
+    @property
+    def next_time_point(self):
+        return self.next_time_point_after(dt.now())
+
     @property
     def repetition_mode(self):
         return self._repetition_mode
@@ -188,15 +648,6 @@ class JobData:
         self._repetition_value = value
         self.update_time_points()
 
-    @property
-    def repetition_value(self):
-        return self._repetition_value
-
-    @repetition_value.setter
-    def repetition_value(self, value):
-        self._repetition_value = value
-        self.update_time_points()
-
     @property
     def timestamp_start(self):
         return self._timestamp_start
@@ -222,11 +673,203 @@ class JobData:
         self.update_time_points()
 
 
+class JobBatch:
+    """Jobs firing close together, run as a single carousel sweep
+
+    The batch stands in for a JobData as the job in progress, its plants are the
+    union of the plants of all its jobs.
+    """
+
+    def __init__(self, jobs: list) -> None:
+        self.jobs = jobs
+        self.name = " + ".join(j.name for j in jobs)
+        self.guid = "+".join(j.guid for j in jobs)
+        if any(j.plants is None for j in jobs):
+            # One of the jobs wants all the plants
+            self.plants = None
+        else:
+            self.plants = list(dict.fromkeys(p for j in jobs for p in j.plants))
+        self.state = JobState.INACTIVE
+
+    def owners_of(self, plant_name) -> list:
+        """Returns the jobs of the batch that asked for plant_name, jobs without
+        a plant list ask for all of them"""
+        return [j for j in self.jobs if j.plants is None or plant_name in j.plants]
+
+
+class JobScheduler:
+    """Keeps enabled jobs in a heap keyed by their next fire time
+
+    Edited or deleted jobs are not searched for in the heap, their entry is
+    invalidated in place and skipped when it reaches the top.
+    on_change is called whenever the schedule is modified so that a launch
+    timer can be re-armed.
+    """
+
+    def __init__(self, jobs: list = None) -> None:
+        self._heap = []
+        self._entries = {}
+        self._counter = count()
+        self.on_change = None
+        self.reset(jobs or [])
+
+    def _notify(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def reset(self, jobs: list):
+        self._heap = []
+        self._entries = {}
+        n = dt.now()
+        for job in jobs:
+            self._push(job=job, moment=n)
+        self._notify()
+
+    def _push(self, job: JobData, moment: dt):
+        self._invalidate(job)
+        fire_time = job.next_time_point_after(moment)
+        if fire_time is None:
+            return
+        entry = [fire_time, next(self._counter), job]
+        self._entries[job.guid] = entry
+        heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._entries) + 16:
+            self._heap = [e for e in self._heap if e[2] is not None]
+            heapify(self._heap)
+
+    def _invalidate(self, job: JobData):
+        entry = self._entries.pop(job.guid, None)
+        if entry is not None:
+            entry[2] = None
+
+    def add(self, job: JobData):
+        self._push(job=job, moment=dt.now())
+        self._notify()
+
+    def update(self, job: JobData):
+        self._push(job=job, moment=dt.now())
+        self._notify()
+
+    def remove(self, job: JobData):
+        self._invalidate(job)
+        self._notify()
+
+    def fired(self, job: JobData, fire_time: dt = None):
+        """Re-keys the job to its first occurrence after the one that fired"""
+        n = dt.now()
+        moment = n if fire_time is None else max(fire_time, n)
+        self._push(job=job, moment=moment + td(microseconds=1))
+        self._notify()
+
+    def peek(self, moment: dt = None):
+        """Returns (fire time, job) of the next job to fire, None if there is none
+
+        The schedule is not changed, entries whose fire time has passed without
+        being launched are only re-keyed when their job is fired.
+        """
+        moment = dt.now() if moment is None else moment
+        while self._heap and self._heap[0][2] is None:
+            # Invalidated entries carry no job, dropping them changes nothing
+            heappop(self._heap)
+        if not self._heap:
+            return None
+        fire_time, _, job = self._heap[0]
+        if fire_time >= moment:
+            return fire_time, job
+        # Missed entries are at the top, compute the next time of every job
+        upcoming = []
+        for fire_time, _, job in self._entries.values():
+            if fire_time < moment:
+                fire_time = job.next_time_point_after(moment)
+            if fire_time is not None:
+                upcoming.append((fire_time, job))
+        return min(upcoming, key=lambda e: e[0]) if upcoming else None
+
+    def due_within(self, window: float, fire_time: dt, job: JobData) -> list:
+        """Returns (fire time, job) for the job firing at fire_time followed by
+        the other jobs firing less than window seconds after it, in time order
+
+        Times are computed from fire_time, the heap is left untouched.
+        """
+        limit = fire_time + td(seconds=window)
+        others = []
+        for entry_time, _, other in self._entries.values():
+            if other.guid == job.guid:
+                continue
+            if entry_time < fire_time:
+                entry_time = other.next_time_point_after(fire_time)
+            if entry_time is not None and entry_time <= limit:
+                others.append((entry_time, other))
+        return [(fire_time, job)] + sorted(others, key=lambda e: e[0])
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def run_on_main_thread(callback, *args, **kwargs):
+    from kivy.clock import Clock
+
+    Clock.schedule_once(lambda dt: callback(*args, **kwargs))
+
+
+class CapturePipeline:
+    """Runs capture storage tasks in order on a background thread
+
+    The queue is bounded and submit never blocks, it returns False when the
+    robot is already max_pending images ahead of the storage so that the
+    caller can store the image itself.
+    """
+
+    def __init__(self, max_pending: int = 4) -> None:
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+
+    def submit(self, task) -> bool:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="capture_pipeline", daemon=True
+            )
+            self._thread.start()
+        try:
+            self._queue.put_nowait(task)
+        except queue.Full:
+            return False
+        return True
+
+    def join(self):
+        self._queue.join()
+
+    def call_when_idle(self, callback):
+        """Calls callback from a helper thread once every queued task is done"""
+
+        def wait():
+            self._queue.join()
+            callback()
+
+        threading.Thread(
+            target=wait, name="capture_pipeline_idle", daemon=True
+        ).start()
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                task()
+            except Exception as e:
+                logger.error(f"Capture pipeline task failed because {repr(e)}")
+            finally:
+                self._queue.task_done()
+
+
 class Controller:
     def __init__(self, **kwargs) -> None:
         self.current_position: int = 0
         self.waiting_for: list = {}
-        self.plant_data = None
+        self._plant_data = None
         self.log_data = []
         self.settings = None
         self.callback = None
@@ -235,9 +878,24 @@ class Controller:
         self.current_request = None
         self.go_home_timeout_count = 0
 
-        self.camera = PiCamera()
+        # Replaced by the backend chosen in the settings, opened on first capture
+        self.camera: CameraBackend = PiCameraBackend()
 
         self.job_in_progress = None
+        self.job_plan = None
+        self.capture_pipeline = CapturePipeline()
+        self.upload_worker = UploadWorker(
+            dispatch=run_on_main_thread,
+            is_busy=lambda: self.job_in_progress is not None,
+        )
+        self.transcoder = Transcoder()
+        self.camera_streaming = False
+        self.exposure_locked = False
+        self._pillow_available = None
+        self.jobs_data = []
+        self.scheduler = JobScheduler()
+        self.store = StateStore(state_db_path)
+        self.catalogue = get_catalogue()
 
         self.robot_state = {
             "current_state": -1,
@@ -249,33 +907,70 @@ class Controller:
 
     def save_settings(self):
         try:
-            with open(settings_path, "w") as f:
-                json.dump(self.settings, f, indent=2)
+            self.store.save_settings(self.settings)
         except Exception as e:
             logger.error(f"Failed to save settings because: {repr(e)}")
         else:
             logger.info("Saved settings")
 
-    def save_plant_data(self):
+    @property
+    def plant_data(self):
+        """Plant registry, the file is read on first access"""
+        if self._plant_data is None:
+            self._plant_data = self.load_plant_data()
+        return self._plant_data
+
+    @plant_data.setter
+    def plant_data(self, value):
+        self._plant_data = value
+
+    def load_plant_data(self) -> PlantRegistry:
+        try:
+            return PlantRegistry(
+                PlantRecord(*row) for row in self.store.load_plants()
+            )
+        except Exception as e:
+            logger.error(f"Failed to load plant data because: {repr(e)}")
+        return PlantRegistry()
+
+    def import_plant_data(self, path) -> ImportReport:
+        """Merges a Data In file, only the new plants are written to the store"""
+        report = import_plant_data(
+            path=path,
+            registry=self.plant_data,
+            tray_count=self.settings["tray_count"],
+        )
+        if report.records:
+            try:
+                self.store.add_plants([r.key for r in report.records])
+            except Exception as e:
+                logger.error(f"Failed to save plant data because: {repr(e)}")
+        return report
+
+    def remove_experiments(self, experiments):
+        self.plant_data.remove_experiments(experiments)
         try:
-            self.plant_data.to_csv(plant_data_path, index=False)
+            self.store.remove_experiments(experiments)
         except Exception as e:
             logger.error(f"Failed to save plant data because: {repr(e)}")
-        else:
-            logger.info("Saved plant data")
+
+    def save_job(self, job: JobData):
+        try:
+            self.store.save_jobs([job.to_json()])
+        except Exception as e:
+            logger.error(f"Failed to save job {job.name} because: {repr(e)}")
 
     def save_jobs_data(self):
         try:
-            with open(jobs_file_path, "w") as f:
-                json.dump({"jobs": [j.to_json() for j in self.jobs_data]}, f, indent=2)
+            self.store.save_jobs([j.to_json() for j in self.jobs_data])
         except Exception as e:
             logger.error(f"Failed to save jobs data because: {repr(e)}")
         else:
             logger.info("Saved jobs data")
 
     def save(self):
+        """Plants and jobs are saved as they change, this is a last safety net"""
         self.save_settings()
-        self.save_plant_data()
         self.save_jobs_data()
 
     def push_command(self, command, callback):
@@ -295,7 +990,8 @@ class Controller:
         self.waiting_commands = []
 
     def start_send_tool(self, callback):
-        if USE_SEND_IMAGES_SCRIPT is True:
+        """Launches send_images.py for the time left before the next job"""
+        if USE_SEND_IMAGES_SCRIPT is False:
             return
         # Check script is running
         p1 = subprocess.Popen(["pgrep", "-af", "python"], stdout=subprocess.PIPE)
@@ -307,14 +1003,25 @@ class Controller:
         p1.stdout.close()
         output, err = p2.communicate()
 
-        if (err is not None) or ("send_images.py" not in str(output)):
+        next_fire = self.scheduler.peek()
+        window = upload_window(None if next_fire is None else next_fire[0])
+        if window >= MIN_UPLOAD_WINDOW and (
+            (err is not None) or ("send_images.py" not in str(output))
+        ):
             callback(
-                f"Sender script not active, launching it",
+                f"Sender script not active, launching it for {round(window / 60)} minutes",
                 wipe_after=-1,
                 log_level=logging.INFO,
             )
             try:
-                subprocess.Popen(["python", "src/send_images.py"])
+                subprocess.Popen(
+                    [
+                        "python",
+                        "src/send_images.py",
+                        "--deadline",
+                        str(time.time() + window),
+                    ]
+                )
             except Exception as e:
                 callback(
                     f"Unable to launch file sender because {repr(e)}, images won't be sent to server",
@@ -322,26 +1029,13 @@ class Controller:
                     log_level=logging.ERROR,
                 )
 
-        # Check files are not too ald
-        images = glob.glob(
-            os.path.join(
-                os.path.dirname(__file__),
-                "..",
-                "data",
-                "images",
-                "to_send",
-                "*",
-            )
-        )
-        files_ok = (
-            True
-            if not images
-            else (
-                dt.now()
-                - dt.fromtimestamp(os.path.getmtime(min(images, key=os.path.getctime)))
-            ).seconds
-            < 7200
-        )
+        # Check files are not too old
+        try:
+            oldest = self.catalogue.oldest_pending()
+        except Exception as e:
+            logger.error(f"Unable to query the capture catalogue because {repr(e)}")
+            oldest = None
+        files_ok = oldest is None or (dt.now() - oldest).total_seconds() < 7200
         if not files_ok:
             callback(
                 f"File sender script seems to have an issue, images won't be sent to server",
@@ -351,23 +1045,23 @@ class Controller:
 
     def load(self):
         try:
-            if os.path.isfile(plant_data_path):
-                self.plant_data = pd.read_csv(plant_data_path)
-            else:
-                self.plant_data = pd.DataFrame(
-                    columns=["experiment", "plant_name", "position", "allow_capture"]
+            if not self.store.is_initialized:
+                # First start with the database, bring in the previous files
+                self.store.import_state(
+                    *read_legacy_files(
+                        settings_path,
+                        plant_data_path,
+                        jobs_file_path,
+                        read_plants=read_plant_rows,
+                    )
                 )
+                logger.info(f"Imported settings, plants and jobs to {state_db_path}")
 
-            if os.path.isfile(jobs_file_path):
-                with open(jobs_file_path, "r") as f:
-                    self.jobs_data = [JobData(**j) for j in json.load(f)["jobs"]]
-            else:
-                self.jobs_data = []
+            self.jobs_data = [JobData(**j) for j in self.store.load_jobs()]
+            self.scheduler.reset(self.jobs_data)
 
-            if os.path.isfile(settings_path):
-                with open(settings_path, "r") as f:
-                    self.settings = json.load(f)
-            else:
+            self.settings = self.store.load_settings()
+            if not self.settings:
                 self.settings = {
                     "target_ip": "http://127.0.0.1",
                     "target_port": 8000,
@@ -375,8 +1069,17 @@ class Controller:
                     "tray_count": 56,
                     "image_resolution": "1024x768",
                     "show_images": False,
+                    "coalesce_window": 0,
+                    "pipelined_capture": True,
+                    "image_format": "png",
+                    "jpeg_quality": 85,
+                    "deferred_format": "",
+                    "camera_streaming": True,
+                    "use_video_port": False,
+                    "camera_backend": "picamera",
                 }
-                self.update_camera_resolution()
+            self.camera = create_camera(self.settings)
+            self.update_camera_resolution()
         except Exception as e:
             logger.error(f"Failed to load data because: {repr(e)}")
         else:
@@ -385,24 +1088,32 @@ class Controller:
     def update_camera_resolution(self):
         try:
             self.camera.framerate = 15
-            self.camera.resolution = self.settings["image_resolution"].split("x")
+            self.camera.resolution = self.settings["image_resolution"]
         except Exception as e:
             logger.error(f"Unable to set camera resolution because {repr(e)}")
             self.camera.resolution = (1024, 768)
 
     def get_next_job(self):
-        n = dt.now()
-        available_jobs = sorted(
-            [
-                j
-                for j in self.jobs_data
-                if j.enabled is True
-                and j.timestamp_start <= n <= j.timestamp_end
-                and j.next_time_point is not None
-            ],
-            key=lambda x: x.next_time_point,
-        )
-        return available_jobs[0] if available_jobs else None
+        next_fire = self.scheduler.peek()
+        return next_fire[1] if next_fire is not None else None
+
+    def add_job(self, job: JobData):
+        self.jobs_data.append(job)
+        self.scheduler.add(job)
+        self.save_job(job)
+
+    def update_job(self, job: JobData):
+        self.scheduler.update(job)
+        self.save_job(job)
+
+    def delete_job(self, index: int):
+        job = self.jobs_data.pop(index)
+        self.scheduler.remove(job)
+        try:
+            self.store.delete_job(job.guid)
+        except Exception as e:
+            logger.error(f"Failed to delete job {job.name} because: {repr(e)}")
+        return job
 
     def state_to_text(self):
         if self.job_in_progress is None:
@@ -480,23 +1191,29 @@ class Controller:
                         log_level=logging.INFO,
                     )
                     self.job_in_progress.state = JobState.INACTIVE
-                    self.job_in_progress = None
+                    self.release_job()
             elif received_command == "go_next":
-                plant = self.get_current_plant()
-                if plant is None:
+                tray = self.get_current_tray()
+                if tray is None:
                     self.callback(
                         message=f"Job {self.job_in_progress.name} - Position error",
                         wipe_after=-1,
                         log_level=logging.ERROR,
                     )
-                elif not plant:
+                elif tray.action == TrayAction.EMPTY:
                     self.callback(
                         message=f"Job {self.job_in_progress.name} - Tray {self.robot_state['current_state']} empty, moving to next",
                         wipe_after=-1,
                         log_level=logging.INFO,
                     )
-                elif plant["allow_capture"]:
+                elif tray.action == TrayAction.CAPTURE:
                     self.snap(callback=self.callback)
+                elif tray.action == TrayAction.NOT_IN_JOB:
+                    self.callback(
+                        message=f"Job {self.job_in_progress.name} - {self.get_plant_desc()} not in job plants, moving to next",
+                        wipe_after=-1,
+                        log_level=logging.INFO,
+                    )
                 else:
                     self.callback(
                         message=f"Job {self.job_in_progress.name} - {self.get_plant_desc()} excluded from image capture",
@@ -555,6 +1272,8 @@ class Controller:
 
     def send_request(self, command, callback=None):
         logger.info(f"Sending {command}")
+        from kivy.network.urlrequest import UrlRequest
+
         if callback is not None:
             self.callback = callback
         self.current_request = UrlRequest(
@@ -580,7 +1299,7 @@ class Controller:
                     log_level=logging.INFO,
                 )
                 self.job_in_progress.state = JobState.INACTIVE
-                self.job_in_progress = None
+                self.release_job()
             self.robot_state["last_state"] = -1
             self.robot_state["current_state"] = -1
             if USE_UDP is True:
@@ -610,7 +1329,7 @@ class Controller:
                 log_level=logging.INFO,
             )
             self.job_in_progress.state = JobState.INACTIVE
-            self.job_in_progress = None
+            self.release_job()
         elif self.awaiting_command is False:
             self.awaiting_command = True
             if command == "go_next":
@@ -625,19 +1344,30 @@ class Controller:
         elif self.awaiting_command is True:
             self.push_command(command=command, callback=callback)
 
-    def get_current_plant(self):
-        if self.robot_state["current_state"] >= 1:
-            tmp = self.plant_data[
-                self.plant_data.position == self.robot_state["current_state"]
-            ]
-            if tmp.shape[0] == 0:
-                return {}
-            else:
-                return tmp.reset_index(drop=True).iloc[0].to_dict()
+    def get_current_tray(self):
+        if self.robot_state["current_state"] >= 1 and self.job_plan is not None:
+            return self.job_plan[self.robot_state["current_state"]]
         else:
             return None
 
+    def get_current_plant(self):
+        if self.robot_state["current_state"] < 1:
+            return None
+        elif self.job_plan is not None:
+            return self.job_plan[self.robot_state["current_state"]].plant
+        else:
+            plant = self.plant_data.at_position(self.robot_state["current_state"])
+            return {} if plant is None else plant.to_dict()
+
     def snap_request(self):
+        tray = self.get_current_tray()
+        if tray is not None:
+            if tray.action == TrayAction.CAPTURE:
+                return "allowed"
+            elif tray.action == TrayAction.EMPTY:
+                return "empty"
+            else:
+                return "disabled"
         plant = self.get_current_plant()
         if plant is None:
             return "no_tray"
@@ -665,63 +1395,89 @@ class Controller:
             return f"[exp:{plant['experiment']}][name:{plant['plant_name']}][pos:{plant['position']}]"
 
     def send_image(self, source_path):
-        src_file_name = os.path.basename(source_path)
-        exp_folder = src_file_name.split("#")[1]
-        if server_conf:
-            p = paramiko.SSHClient()
-            p.set_missing_host_key_policy(paramiko.AutoAddPolicy)
-            p.connect(
-                server_conf["address"],
-                port=server_conf["port"],
-                username=server_conf["user"],
-                password=server_conf["password"],
+        return send_image(source_path=source_path)
+
+    def start_camera_stream(self):
+        """Keeps the camera running for a whole job instead of once per snap"""
+        if self.camera_streaming:
+            return
+        try:
+            self.camera.start_preview()
+        except Exception as e:
+            logger.error(f"Unable to start camera stream because {repr(e)}")
+        else:
+            self.camera_streaming = True
+            self.exposure_locked = False
+            logger.info("Camera stream started")
+
+    def lock_camera_exposure(self):
+        """Freezes exposure and white balance to the values of the first tray"""
+        try:
+            locked = self.camera.lock_exposure()
+        except Exception as e:
+            logger.error(f"Unable to lock camera exposure because {repr(e)}")
+        else:
+            logger.info(f"Camera exposure locked, {locked}")
+        self.exposure_locked = True
+
+    def stop_camera_stream(self):
+        if not self.camera_streaming:
+            return
+        self.camera_streaming = False
+        self.exposure_locked = False
+        try:
+            self.camera.stop_preview()
+            self.camera.unlock_exposure()
+        except Exception as e:
+            logger.error(f"Unable to stop camera stream because {repr(e)}")
+        else:
+            logger.info("Camera stream stopped")
+
+    def capture_still(self, output, fmt, options):
+        if self.camera_streaming:
+            self.camera.capture(
+                output,
+                format=fmt,
+                use_video_port=self.settings.get("use_video_port", False),
+                **options,
             )
-            ftp = p.open_sftp()
-            ftp.chdir("RobotRacine")
-            try:
-                try:
-                    ftp.stat(exp_folder)
-                except FileNotFoundError:
-                    logger.info(f"Creating {exp_folder} folder")
-                    ftp.mkdir(exp_folder)
-                ftp.put(source_path, os.path.join(exp_folder, src_file_name))
-            except Exception as e:
-                logger.error(f"Unable to move {src_file_name} because {repr(e)}")
-            else:
-                # Check file size and delete source
-                if (
-                    os.path.getsize(source_path)
-                    == ftp.stat(os.path.join(exp_folder, src_file_name)).st_size
-                ):
-                    logger.info(f"Moved {src_file_name}, moved source to sent folder")
-                    shutil.move(source_path, source_path.replace("to_send", "sent"))
-                else:
-                    logger.error(f"Wrong destination file size: {src_file_name}")
-            finally:
-                ftp.close()
-                p.close()
+            if not self.exposure_locked:
+                self.lock_camera_exposure()
         else:
-            # Find the target folder
-            for fld in glob.glob(os.path.join("/", "media", "pi", "*")):
-                if os.path.isdir(os.path.join(fld, "robot_racine", "")):
-                    base_target_folder = os.path.join(fld, "robot_racine", "")
-                    break
-            else:
-                base_target_folder = ""
-                logger.warning("No target folder found, will not move images")
-            if base_target_folder:
-                try:
-                    target_folder = os.path.join(base_target_folder, exp_folder)
-                    if not os.path.exists(target_folder):
-                        os.makedirs(target_folder)
-                    shutil.move(
-                        source_path,
-                        os.path.join(target_folder, src_file_name),
-                    )
-                except Exception as e:
-                    logger.error(f"Unable to move {src_file_name} because {repr(e)}")
-                else:
-                    logger.info(f"Moved {src_file_name}")
+            self.camera.start_preview()
+            self.camera.capture(output, format=fmt, **options)
+            self.camera.stop_preview()
+
+    def release_job(self):
+        self.job_in_progress = None
+        self.job_plan = None
+        self.stop_camera_stream()
+
+    def when_captures_stored(self, callback):
+        """Calls callback on the main thread once the captures queued so far are
+        stored"""
+        self.capture_pipeline.call_when_idle(partial(run_on_main_thread, callback))
+
+    def capture_settings(self):
+        """Returns capture format, file extension, capture options and the
+        lossless format raw captures are transcoded to, if any
+        """
+        deferred = self.settings.get("deferred_format", "")
+        if deferred in DEFERRED_FORMATS:
+            if self._pillow_available is None:
+                self._pillow_available = pillow_available()
+                if not self._pillow_available:
+                    logger.error("Pillow is not installed, captures won't be deferred")
+            if self._pillow_available:
+                return "rgb", DEFERRED_FORMATS[deferred], {}, deferred
+        fmt = self.settings.get("image_format", "png")
+        if fmt not in CAPTURE_FORMATS:
+            logger.error(f"Unknown image format {fmt}, using png")
+            fmt = "png"
+        options = {}
+        if fmt == "jpeg":
+            options["quality"] = int(self.settings.get("jpeg_quality", 85))
+        return fmt, CAPTURE_FORMATS[fmt], options, None
 
     def snap(self, callback, save_image: bool = True):
         sr = self.snap_request()
@@ -731,71 +1487,304 @@ class Controller:
                 wipe_after=-1,
                 log_level=logging.WARNING,
             )
+            return
+
+        if self.job_in_progress is None:
+            prefix = ""
         else:
-            try:
-                self.camera.start_preview()
-                self.camera.capture(self.path_to_last_image)
-                self.camera.stop_preview()
-                if save_image is True:
-                    target_folder = (
-                        "to_send"
-                        if (self.job_in_progress is not None) and (sr == "allowed")
-                        else "to_keep"
+            prefix = f"Job {self.job_in_progress.name} - "
+        if sr == "empty":
+            message, log_level = f"{prefix} Snapped at nothing", logging.WARNING
+        elif sr == "no_tray":
+            message, log_level = f"{prefix} No tray in position", logging.WARNING
+        else:
+            message, log_level = f"Snapped {self.get_plant_desc()}", logging.INFO
+
+        fmt, extension, options, deferred = self.capture_settings()
+        target_file = None
+        entry = {}
+        if save_image is True:
+            target_folder = (
+                "to_send"
+                if (self.job_in_progress is not None) and (sr == "allowed")
+                else "to_keep"
+            )
+            target_file = os.path.join(
+                os.path.dirname(__file__),
+                "..",
+                "data",
+                "images",
+                target_folder,
+                f"{self.get_picture_name()}{extension}",
+            )
+            entry = self.capture_entry(
+                target_folder=target_folder, fmt=fmt, options=options, deferred=deferred
+            )
+
+        try:
+            if (
+                target_file is not None
+                and self.job_in_progress is not None
+                and self.settings.get("pipelined_capture", True) is True
+            ):
+                # Only the sensor is waited for, the robot can move on while the
+                # image is stored and sent by the pipeline
+                stream = io.BytesIO()
+                self.capture_still(output=stream, fmt=fmt, options=options)
+                task = partial(
+                    self.store_capture,
+                    stream=stream,
+                    target_file=target_file,
+                    entry=entry,
+                    callback=callback,
+                    message=message,
+                    log_level=log_level,
+                    deferred=deferred,
+                    resolution=tuple(self.camera.resolution),
+                )
+                if not self.capture_pipeline.submit(task):
+                    # Storage is behind, hold the robot while this one is stored
+                    callback(
+                        f"{prefix}Storage behind, storing image before moving on",
+                        wipe_after=5,
+                        log_level=logging.WARNING,
                     )
-                    target_file = os.path.join(
-                        os.path.dirname(__file__),
-                        "..",
-                        "data",
-                        "images",
-                        target_folder,
-                        f"{self.get_picture_name()}.png",
+                    task()
+                return
+            if target_file is None:
+                # last_picture.png may be a link to a stored capture, replace it
+                # instead of writing through it
+                temp_file = self.temp_path_for(self.path_to_last_image)
+                self.capture_still(output=temp_file, fmt="png", options={})
+                os.replace(temp_file, self.path_to_last_image)
+            else:
+                # Encode once into the images folder, then only rename and link
+                temp_file = self.temp_path_for(target_file, raw=deferred is not None)
+                self.capture_still(output=temp_file, fmt=fmt, options=options)
+                if deferred is not None:
+                    self.defer_capture(
+                        raw_file=temp_file,
+                        target_file=target_file,
+                        entry=entry,
+                        callback=callback,
+                        message=message,
+                        log_level=log_level,
+                        deferred=deferred,
+                        resolution=tuple(self.camera.resolution),
                     )
-                    shutil.copy(self.path_to_last_image, target_file)
-                    if target_folder == "to_send" and USE_SEND_IMAGES_SCRIPT is False:
-                        self.send_image(source_path=target_file)
-            except Exception as e:
-                callback(
-                    f"Failed to capture image because {repr(e)}",
-                    wipe_after=-1,
-                    log_level=logging.ERROR,
+                    return
+                self.place_capture(temp_file=temp_file, target_file=target_file)
+                self.after_capture(
+                    target_file=target_file, entry=entry, callback=callback
                 )
-                return
+        except Exception as e:
+            callback(
+                f"Failed to capture image because {repr(e)}",
+                wipe_after=-1,
+                log_level=logging.ERROR,
+            )
+            return
 
-            if self.job_in_progress is None:
-                prefix = ""
-            else:
-                prefix = f"Job {self.job_in_progress.name} - "
+        callback(
+            message,
+            wipe_after=-1,
+            log_level=log_level,
+            update_captured_image=True,
+        )
 
-            if sr == "empty":
-                callback(
-                    f"{prefix} Snapped at nothing",
-                    wipe_after=-1,
-                    log_level=logging.WARNING,
-                    update_captured_image=True,
+    def start_transcoder(self):
+        """Removes the captures a crash left half done and, if raw captures are
+        transcoded, starts the process pool before they are needed"""
+        removed = remove_orphans(os.path.dirname(self.path_to_last_image))
+        if removed:
+            logger.warning(f"Removed {removed} unfinished captures")
+        if self.capture_settings()[3] is not None:
+            self.transcoder.start()
+
+    def temp_path_for(self, target_file, raw: bool = False):
+        return os.path.join(
+            os.path.dirname(self.path_to_last_image),
+            f".{os.path.basename(target_file)}.{'raw' if raw else 'tmp'}",
+        )
+
+    def place_capture(self, temp_file, target_file):
+        """Moves a finished capture to its folder and makes it the last picture
+
+        Both operations are atomic renames on the same file system, the image
+        data is written only once.
+        """
+        os.replace(temp_file, target_file)
+        if os.path.splitext(target_file)[1] not in [".png", ".jpg", ".bmp", ".webp"]:
+            return
+        temp_link = f"{self.path_to_last_image}.tmp"
+        if os.path.lexists(temp_link):
+            os.remove(temp_link)
+        try:
+            os.link(target_file, temp_link)
+        except OSError:
+            shutil.copy(target_file, temp_link)
+        os.replace(temp_link, self.path_to_last_image)
+
+    def capture_entry(self, target_folder, fmt, options, deferred) -> dict:
+        """Catalogue fields known when the image is taken, before the robot moves"""
+        plant = self.get_current_plant() or {}
+        owners = []
+        if target_folder == "to_send" and plant:
+            owners = self.job_in_progress.owners_of(plant["plant_name"])
+        return {
+            "experiment": plant.get("experiment"),
+            "plant_name": plant.get("plant_name"),
+            "position": plant.get("position"),
+            "job_guids": ";".join(j.guid for j in owners),
+            "job_names": ";".join(j.name for j in owners),
+            "captured_at": dt.now(),
+            "camera": {
+                "backend": self.camera.name,
+                "capture_format": fmt,
+                "format": deferred or fmt,
+                "options": options,
+                "resolution": "x".join(str(v) for v in self.camera.resolution),
+                "streaming": self.camera_streaming,
+                "exposure_locked": self.exposure_locked,
+                "use_video_port": self.camera_streaming
+                and self.settings.get("use_video_port", False),
+            },
+        }
+
+    def after_capture(self, target_file, entry: dict, callback):
+        try:
+            self.catalogue.add(path=target_file, entry=entry)
+        except Exception as e:
+            logger.error(f"Unable to catalogue {target_file} because {repr(e)}")
+        if os.path.basename(os.path.dirname(target_file)) != "to_send":
+            return
+        if USE_SEND_IMAGES_SCRIPT is False:
+            self.upload_worker.enqueue(source_path=target_file, callback=callback)
+
+    def store_capture(
+        self,
+        stream,
+        target_file,
+        entry,
+        callback,
+        message,
+        log_level,
+        deferred=None,
+        resolution=None,
+    ):
+        """Runs on the capture pipeline thread, callbacks go back to the main thread"""
+        try:
+            temp_file = self.temp_path_for(target_file, raw=deferred is not None)
+            with open(temp_file, "wb") as f:
+                f.write(stream.getbuffer())
+            stream.close()
+            if deferred is not None:
+                self.defer_capture(
+                    raw_file=temp_file,
+                    target_file=target_file,
+                    entry=entry,
+                    callback=callback,
+                    message=message,
+                    log_level=log_level,
+                    deferred=deferred,
+                    resolution=resolution,
                 )
-            elif sr == "no_tray":
-                callback(
-                    f"{prefix} No tray in position",
-                    wipe_after=-1,
-                    log_level=logging.WARNING,
-                    update_captured_image=True,
+                return
+            self.place_capture(temp_file=temp_file, target_file=target_file)
+            self.after_capture(
+                target_file=target_file, entry=entry, callback=callback
+            )
+        except Exception as e:
+            run_on_main_thread(
+                callback,
+                f"Failed to store image because {repr(e)}",
+                wipe_after=-1,
+                log_level=logging.ERROR,
+            )
+        else:
+            run_on_main_thread(
+                callback,
+                message,
+                wipe_after=-1,
+                log_level=log_level,
+                update_captured_image=True,
+            )
+
+    def defer_capture(
+        self,
+        raw_file,
+        target_file,
+        entry,
+        callback,
+        message,
+        log_level,
+        deferred,
+        resolution,
+    ):
+        """Hands a raw capture to the transcoder process pool"""
+
+        def on_done(temp_file):
+            try:
+                self.place_capture(temp_file=temp_file, target_file=target_file)
+                self.after_capture(
+                    target_file=target_file, entry=entry, callback=callback
                 )
+            except Exception as e:
+                on_error(e)
             else:
-                callback(
-                    f"Snapped {self.get_plant_desc()}",
+                run_on_main_thread(
+                    callback,
+                    message,
                     wipe_after=-1,
-                    log_level=logging.INFO,
+                    log_level=log_level,
                     update_captured_image=True,
                 )
 
-    def execute_job(self, job: JobData, callback):
+        def on_error(e):
+            run_on_main_thread(
+                callback,
+                f"Failed to encode {os.path.basename(target_file)} because {repr(e)}",
+                wipe_after=-1,
+                log_level=logging.ERROR,
+            )
+
+        width, height = resolution
+        self.transcoder.submit(
+            raw_path=raw_file,
+            temp_path=self.temp_path_for(target_file),
+            width=width,
+            height=height,
+            fmt=deferred,
+            on_done=on_done,
+            on_error=on_error,
+        )
+
+    def execute_job(self, job: JobData, callback, fire_time: dt = None):
+        self.execute_jobs(entries=[(fire_time, job)], callback=callback)
+
+    def execute_jobs(self, entries: list, callback):
+        """Runs all the (fire time, job) entries in a single sweep"""
+        for fire_time, job in entries:
+            self.scheduler.fired(job=job, fire_time=fire_time)
+        if len(entries) == 1:
+            job = entries[0][1]
+        else:
+            job = JobBatch(jobs=[job for _, job in entries])
+        self.job_plan = JobPlan.compile(
+            plants=self.plant_data,
+            job_plants=job.plants,
+            tray_count=self.settings["tray_count"],
+        )
         callback(
-            f"Starting Job {job.name}",
+            f"Starting Job {job.name}, {self.job_plan.capture_count} plants to capture",
             wipe_after=-1,
             log_level=logging.INFO,
         )
         self.job_in_progress = job
         self.job_in_progress.state = JobState.WAITING_HOME
+        if self.settings.get("camera_streaming", True) is True:
+            # Started now so that the sensor settles while the robot goes home
+            self.start_camera_stream()
         self.send_command(
             command="go_home_dirty",
             callback=callback,
@@ -834,86 +1823,4 @@ class Controller:
 
 
 def send_pictures(work_seconds: int):
-    start = timer()
-
-    src_folder = os.path.join(
-        os.path.dirname(__file__), "..", "data", "images", "to_send", ""
-    )
-
-    if server_conf:
-        p = paramiko.SSHClient()
-        p.set_missing_host_key_policy(paramiko.AutoAddPolicy)
-        p.connect(
-            server_conf["address"],
-            port=server_conf["port"],
-            username=server_conf["user"],
-            password=server_conf["password"],
-        )
-        ftp = p.open_sftp()
-        ftp.chdir("RobotRacine")
-        for name in os.listdir(src_folder):
-            if (timer() - start) >= work_seconds:
-                logger.info(
-                    f"Stopping sending images to avoid job conflicts after {(timer() - start) / 60} minutes"
-                )
-                break
-            try:
-                exp_folder = os.path.basename(name).split("#")[1]
-                try:
-                    ftp.chdir(exp_folder)
-                except IOError:
-                    logger.info(f"Creating {exp_folder} folder")
-                    ftp.mkdir(exp_folder)
-                    ftp.chdir(exp_folder)
-                ftp.put(os.path.join(src_folder, name), name)
-            except Exception as e:
-                logger.error(f"Unable to move {name} because {repr(e)}")
-            else:
-                # Check file size and delete source
-                if (
-                    os.path.getsize(os.path.join(src_folder, name))
-                    == ftp.stat(name).st_size
-                ):
-                    logger.info(f"Moved {name}, deleted source")
-                else:
-                    logger.error(f"Wrong destination file size: {name}")
-
-                ftp.chdir("..")
-        else:
-            logger.info("Ended file sending")
-        ftp.close()
-        p.close()
-    else:
-        # Find the target folder
-        for fld in glob.glob(os.path.join("/", "media", "pi", "*")):
-            if os.path.isdir(os.path.join(fld, "robot_racine", "")):
-                base_target_folder = os.path.join(fld, "robot_racine", "")
-                break
-        else:
-            base_target_folder = ""
-            logger.warning("No target folder found, will not move images")
-        if base_target_folder:
-            for name in os.listdir(src_folder):
-                if (timer() - start) >= work_seconds:
-                    logger.info(
-                        f"Stopping sending images to avoid job conflicts after {(timer() - start) / 60} minutes"
-                    )
-                    break
-                try:
-                    # Get experiment name
-                    target_folder = os.path.join(
-                        base_target_folder, os.path.basename(name).split("#")[1]
-                    )
-                    if not os.path.exists(target_folder):
-                        os.makedirs(target_folder)
-
-                    shutil.move(
-                        os.path.join(src_folder, name),
-                        os.path.join(target_folder, name),
-                    )
-                except Exception as e:
-                    logger.error(f"Unable to move {name} because {repr(e)}")
-                else:
-                    logger.info(f"Moved {name}")
-            else:
-                logger.info("Ended file sending")
+    send_pending_images(work_seconds=work_seconds)
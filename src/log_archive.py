@@ -0,0 +1,346 @@
+import os
+import re
+import io
+import glob
+import gzip
+import json
+import logging
+import argparse
+from datetime import datetime as dt
+from datetime import timedelta as td
+
+logger = logging.getLogger("robot_racine")
+
+logs_folder = os.path.join(os.path.dirname(__file__), "..", "logs")
+archive_folder = os.path.join(logs_folder, "archive")
+
+# Daily log files, name_YYYYMMDD.log, archives of a day archived twice get a time
+LOG_FILE_PATTERN = re.compile(r"^(?P<source>.+)_(?P<day>\d{8})(_\d{6})?\.log$")
+# [time - (fields - )name - LEVEL] - message
+RECORD_PATTERN = re.compile(
+    r"^\[(?P<time>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - (?P<fields>.*?)"
+    r" - (?P<level>DEBUG|INFO|WARNING|ERROR|CRITICAL)\] - (?P<message>.*)$"
+)
+JOB_START_PATTERN = re.compile(r"^Starting Job (?P<job>.+), \d+ plants to capture")
+JOB_MESSAGE_PATTERN = re.compile(r"^Job (?P<job>.+?) - (?P<event>.+)$")
+JOB_END_EVENTS = ["Ended", "Cancelled"]
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S,%f"
+
+LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+# Records per gzip member, each member can be decompressed on its own
+BLOCK_RECORDS = 500
+
+ARCHIVE_MAX_AGE_DAYS = 180
+ARCHIVE_MAX_SIZE = 512 * 1024 * 1024
+# Files written to more recently than this may still be open
+OPEN_FILE_GRACE = 3600
+
+
+class LogRecordText:
+    """One record of a log file, with its continuation lines
+
+    job is the job the record belongs to, running the job still in progress
+    after the record.
+    """
+
+    __slots__ = ("time", "name", "level", "job", "running", "text")
+
+    def __init__(self, time, name, level, job, running, text) -> None:
+        self.time = time
+        self.name = name
+        self.level = level
+        self.job = job
+        self.running = running
+        self.text = text
+
+
+def parse_records(lines, job=None):
+    """Groups log lines in records and attributes them to the running job
+
+    Lines before the first record header, or that are not headers, are added
+    to the previous record (tracebacks, multi line messages). job is the job
+    in progress before the first line.
+    """
+    current = None
+    for line in lines:
+        match = RECORD_PATTERN.match(line.rstrip("\n"))
+        if match is None:
+            if current is not None:
+                current.text += line
+            continue
+        if current is not None:
+            yield current
+        message = match.group("message")
+        record_job = job
+        start = JOB_START_PATTERN.match(message)
+        if start is not None:
+            job = record_job = start.group("job")
+        else:
+            job_message = JOB_MESSAGE_PATTERN.match(message)
+            if job_message is not None:
+                record_job = job_message.group("job")
+                if job_message.group("event") in JOB_END_EVENTS:
+                    job = None
+        current = LogRecordText(
+            time=dt.strptime(match.group("time"), TIME_FORMAT),
+            name=match.group("fields").split(" - ")[-1],
+            level=match.group("level"),
+            job=record_job,
+            running=job,
+            text=line if line.endswith("\n") else line + "\n",
+        )
+    if current is not None:
+        yield current
+
+
+def job_matches(record_job, wanted) -> bool:
+    """Batched jobs are logged as "a + b", each of them matches"""
+    return record_job is not None and (
+        record_job == wanted or wanted in record_job.split(" + ")
+    )
+
+
+def record_matches(record, start=None, end=None, level=None, job=None) -> bool:
+    if start is not None and record.time < start:
+        return False
+    if end is not None and record.time >= end:
+        return False
+    if level is not None and LEVELS.index(record.level) < LEVELS.index(level):
+        return False
+    if job is not None and not job_matches(record.job, job):
+        return False
+    return True
+
+
+def archive_paths(source, day):
+    path = os.path.join(archive_folder, f"{source}_{day}.log.gz")
+    return path, path + ".idx"
+
+
+def archive_log(log_path) -> str:
+    """Compresses a closed log file in blocks and writes its index
+
+    The archive is a sequence of gzip members of BLOCK_RECORDS records, the
+    index holds one json line per member with its offset, length, time range,
+    levels and job names. The log file is removed once both are written.
+    """
+    match = LOG_FILE_PATTERN.match(os.path.basename(log_path))
+    if match is None:
+        raise ValueError(f"{log_path} is not a daily log file")
+    os.makedirs(archive_folder, exist_ok=True)
+    archive_path, index_path = archive_paths(match.group("source"), match.group("day"))
+    if os.path.isfile(archive_path):
+        # Same day already archived, keep both
+        archive_path, index_path = archive_paths(
+            match.group("source"),
+            f"{match.group('day')}_{dt.now().strftime('%H%M%S')}",
+        )
+
+    blocks = []
+    with open(log_path, "r", errors="replace") as src, open(
+        archive_path + ".tmp", "wb"
+    ) as dst:
+
+        def write_block(records, running):
+            data = "".join(r.text for r in records).encode("utf-8")
+            offset = dst.tell()
+            dst.write(gzip.compress(data))
+            blocks.append(
+                {
+                    "offset": offset,
+                    "length": dst.tell() - offset,
+                    "start": records[0].time.strftime(TIME_FORMAT),
+                    "end": records[-1].time.strftime(TIME_FORMAT),
+                    "levels": sorted({r.level for r in records}, key=LEVELS.index),
+                    "jobs": sorted({r.job for r in records if r.job is not None}),
+                    "running": running,
+                }
+            )
+
+        block = []
+        running = None
+        for record in parse_records(src):
+            block.append(record)
+            if len(block) >= BLOCK_RECORDS:
+                write_block(block, running)
+                running = record.running
+                block = []
+        if block:
+            write_block(block, running)
+
+    with open(index_path + ".tmp", "w") as f:
+        for block in blocks:
+            f.write(json.dumps(block) + "\n")
+    os.replace(archive_path + ".tmp", archive_path)
+    os.replace(index_path + ".tmp", index_path)
+    os.remove(log_path)
+    return archive_path
+
+
+def archive_day(archive_path) -> str:
+    match = LOG_FILE_PATTERN.match(os.path.basename(archive_path)[: -len(".gz")])
+    return "" if match is None else match.group("day")
+
+
+def prune_archives(max_age_days=ARCHIVE_MAX_AGE_DAYS, max_size=ARCHIVE_MAX_SIZE):
+    """Deletes the archives older than max_age_days, then the oldest until the
+    archive folder is smaller than max_size"""
+    archives = sorted(
+        glob.glob(os.path.join(archive_folder, "*.log.gz")), key=archive_day
+    )
+    limit = (dt.now() - td(days=max_age_days)).strftime("%Y%m%d")
+    total = sum(os.path.getsize(p) for p in archives)
+    removed = 0
+    for path in archives:
+        if archive_day(path) >= limit and total <= max_size:
+            break
+        total -= os.path.getsize(path)
+        for target in [path, path + ".idx"]:
+            if os.path.isfile(target):
+                os.remove(target)
+        removed += 1
+    return removed
+
+
+def rotate_logs(
+    max_age_days=ARCHIVE_MAX_AGE_DAYS, max_size=ARCHIVE_MAX_SIZE, exclude=()
+):
+    """Archives the log files of closed days and prunes old archives
+
+    Files in exclude, and files written to in the last OPEN_FILE_GRACE seconds,
+    are left alone as a running process may still be writing to them.
+    """
+    today = dt.now().strftime("%Y%m%d")
+    exclude = {os.path.abspath(p) for p in exclude}
+    archived = 0
+    for log_path in sorted(glob.glob(os.path.join(logs_folder, "*.log"))):
+        match = LOG_FILE_PATTERN.match(os.path.basename(log_path))
+        if (
+            match is None
+            or match.group("day") >= today
+            or os.path.abspath(log_path) in exclude
+            or dt.now().timestamp() - os.path.getmtime(log_path) < OPEN_FILE_GRACE
+        ):
+            continue
+        try:
+            archive_log(log_path)
+        except Exception as e:
+            logger.error(f"Failed to archive {log_path} because {repr(e)}")
+        else:
+            archived += 1
+    removed = prune_archives(max_age_days=max_age_days, max_size=max_size)
+    logger.info(f"Log rotation: {archived} files archived, {removed} archives removed")
+    return archived, removed
+
+
+def read_index(index_path) -> list:
+    with open(index_path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def block_matches(block, start=None, end=None, level=None, job=None) -> bool:
+    if start is not None and dt.strptime(block["end"], TIME_FORMAT) < start:
+        return False
+    if end is not None and dt.strptime(block["start"], TIME_FORMAT) >= end:
+        return False
+    if level is not None and not any(
+        LEVELS.index(lvl) >= LEVELS.index(level) for lvl in block["levels"]
+    ):
+        return False
+    if job is not None and not any(job_matches(j, job) for j in block["jobs"]):
+        return False
+    return True
+
+
+def query_archive(archive_path, start=None, end=None, level=None, job=None):
+    """Yields the matching records, only reading the blocks that may hold some"""
+    index_path = archive_path + ".idx"
+    if not os.path.isfile(index_path):
+        with gzip.open(archive_path, "rt", errors="replace") as f:
+            for record in parse_records(f):
+                if record_matches(record, start, end, level, job):
+                    yield record
+        return
+    with open(archive_path, "rb") as f:
+        for block in read_index(index_path):
+            if not block_matches(block, start, end, level, job):
+                continue
+            f.seek(block["offset"])
+            data = gzip.decompress(f.read(block["length"])).decode("utf-8")
+            for record in parse_records(io.StringIO(data), job=block.get("running")):
+                if record_matches(record, start, end, level, job):
+                    yield record
+
+
+def query_logs(start=None, end=None, level=None, job=None, source=None):
+    """Yields the matching records of the archives and of the open log files"""
+    sources = []
+    for path in glob.glob(os.path.join(archive_folder, "*.log.gz")):
+        match = LOG_FILE_PATTERN.match(os.path.basename(path)[: -len(".gz")])
+        if match is not None:
+            sources.append((match.group("day"), match.group("source"), path, True))
+    for path in glob.glob(os.path.join(logs_folder, "*.log")):
+        match = LOG_FILE_PATTERN.match(os.path.basename(path))
+        if match is not None:
+            sources.append((match.group("day"), match.group("source"), path, False))
+    for day, src, path, archived in sorted(sources):
+        if source is not None and src != source:
+            continue
+        if end is not None and dt.strptime(day, "%Y%m%d") >= end:
+            # A file starts on its day
+            continue
+        if archived:
+            yield from query_archive(path, start, end, level, job)
+        else:
+            with open(path, "r", errors="replace") as f:
+                for record in parse_records(f):
+                    if record_matches(record, start, end, level, job):
+                        yield record
+
+
+def parse_time(value):
+    for fmt in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+        try:
+            return dt.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"{value} is not a date, use YYYY-MM-DD[ HH:MM]")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive and query Robot Racine logs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rotate_parser = subparsers.add_parser(
+        "rotate", help="Archive closed days and remove old archives"
+    )
+    rotate_parser.add_argument("--max-age", type=int, default=ARCHIVE_MAX_AGE_DAYS)
+    rotate_parser.add_argument(
+        "--max-size", type=int, default=ARCHIVE_MAX_SIZE // (1024 * 1024), help="MB"
+    )
+
+    query_parser = subparsers.add_parser("query", help="Print matching records")
+    query_parser.add_argument("--start", type=parse_time)
+    query_parser.add_argument("--end", type=parse_time)
+    query_parser.add_argument("--level", choices=LEVELS, help="Minimum level")
+    query_parser.add_argument("--job", help="Job name")
+    query_parser.add_argument(
+        "--source", help="Log file prefix, robot_racine, file_sender..."
+    )
+
+    args = parser.parse_args()
+    if args.command == "rotate":
+        archived, removed = rotate_logs(
+            max_age_days=args.max_age, max_size=args.max_size * 1024 * 1024
+        )
+        print(f"{archived} files archived, {removed} archives removed")
+    else:
+        for record in query_logs(
+            start=args.start,
+            end=args.end,
+            level=args.level,
+            job=args.job,
+            source=args.source,
+        ):
+            print(record.text, end="")
@@ -0,0 +1,192 @@
+import os
+import atexit
+import logging
+import queue
+import threading
+from collections import deque, namedtuple
+from datetime import datetime as dt
+from logging.handlers import QueueHandler
+
+LOG_FORMAT = "[%(asctime)s - %(name)s - %(levelname)s] - %(message)s"
+
+LogEntry = namedtuple("LogEntry", ["created", "name", "levelno", "msg", "args"])
+
+LEVEL_FILTERS = {
+    "ALL": logging.NOTSET,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+}
+
+
+def format_entry(entry: LogEntry) -> str:
+    try:
+        message = str(entry.msg) % entry.args if entry.args else str(entry.msg)
+    except (TypeError, ValueError):
+        message = f"{entry.msg} {entry.args}"
+    return (
+        f"[{dt.fromtimestamp(entry.created).strftime('%Y/%m/%d %H:%M:%S')}"
+        f" - {entry.name} - {logging.getLevelName(entry.levelno)}] {message}"
+    )
+
+
+class LogStore:
+    """Keeps the last capacity log records of the watched loggers
+
+    Records are stored raw and only formatted when a page is displayed, the
+    oldest records are dropped once the store is full.
+    """
+
+    def __init__(self, capacity: int = 5000, names=None) -> None:
+        self.names = None if names is None else set(names)
+        self._entries = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    def append(self, record: logging.LogRecord):
+        if self.names is not None and record.name not in self.names:
+            return
+        entry = LogEntry(
+            created=record.created,
+            name=record.name,
+            levelno=record.levelno,
+            msg=record.msg,
+            args=record.args,
+        )
+        with self._lock:
+            self._entries.append(entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def select(self, min_level: int = logging.NOTSET) -> list:
+        """Returns the entries at or above min_level, newest first"""
+        with self._lock:
+            entries = list(self._entries)
+        entries.reverse()
+        if min_level > logging.NOTSET:
+            entries = [e for e in entries if e.levelno >= min_level]
+        return entries
+
+    def page(self, index: int, page_size: int, min_level: int = logging.NOTSET):
+        """Returns the formatted lines of a page and the page count"""
+        entries = self.select(min_level=min_level)
+        page_count = max(1, (len(entries) + page_size - 1) // page_size)
+        index = min(max(index, 0), page_count - 1)
+        start = index * page_size
+        return [format_entry(e) for e in entries[start : start + page_size]], page_count
+
+
+class LogStoreHandler(logging.Handler):
+    """Feeds a LogStore"""
+
+    def __init__(self, store: LogStore, level=logging.NOTSET) -> None:
+        super().__init__(level=level)
+        self.store = store
+
+    def emit(self, record):
+        self.store.append(record)
+
+
+class BatchFileHandler(logging.FileHandler):
+    """File handler that leaves flushing to the listener, once per batch"""
+
+    def emit(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class DailyFileHandler(BatchFileHandler):
+    """Batch file handler writing to folder/prefix_YYYYMMDD.log, a new file is
+    started with the first record of each day so that closed days can be
+    archived while the process runs"""
+
+    def __init__(self, folder, prefix, mode="a", delay=True) -> None:
+        self.folder = folder
+        self.prefix = prefix
+        self.day = dt.now().strftime("%Y%m%d")
+        super().__init__(self.path_for(self.day), mode=mode, delay=delay)
+
+    def path_for(self, day) -> str:
+        return os.path.join(self.folder, f"{self.prefix}_{day}.log")
+
+    def emit(self, record):
+        day = dt.fromtimestamp(record.created).strftime("%Y%m%d")
+        if day > self.day:
+            self.day = day
+            self.close()
+            self.baseFilename = os.path.abspath(self.path_for(day))
+        super().emit(record)
+
+
+class BatchingQueueListener:
+    """Handles all the records waiting in the queue before flushing the handlers
+
+    Records are handled on the listener's own thread, stop enqueues None as
+    the end marker and waits for everything before it to be written.
+    """
+
+    def __init__(self, log_queue, *handlers, max_batch: int = 256) -> None:
+        self.queue = log_queue
+        self.handlers = handlers
+        self.max_batch = max_batch
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="log_listener", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.queue.put_nowait(None)
+            self._thread.join()
+            self._thread = None
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is None:
+                    stop = True
+                else:
+                    self.handle(record)
+            for handler in self.handlers:
+                handler.flush()
+
+
+def start_queue_logging(
+    handlers: list, level=logging.DEBUG
+) -> BatchingQueueListener:
+    """Routes the root logger through a queue so that callers never wait on disk
+
+    The handlers run on the listener thread, which is stopped and flushed when
+    the process exits.
+    """
+    formatter = logging.Formatter(LOG_FORMAT)
+    for handler in handlers:
+        if handler.formatter is None:
+            handler.setFormatter(formatter)
+    log_queue = queue.Queue(-1)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(QueueHandler(log_queue))
+    listener = BatchingQueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
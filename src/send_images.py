@@ -4,19 +4,11 @@ from time import sleep
 import logging
 from datetime import datetime as dt
 import sys
-import shutil
-import glob
 import argparse
-from timeit import default_timer as timer
 
-import paramiko
-
-try:
-    from server_credentials import connection_data
-except Exception as e:
-    server_conf = {}
-else:
-    server_conf = connection_data.get("phenopsis", {})
+from uploader import send_pending_images
+from upload_scheduler import upload_window
+from log_store import BatchFileHandler, start_queue_logging
 
 lock_file = os.path.join(
     os.path.dirname(__file__),
@@ -26,13 +18,13 @@ lock_file = os.path.join(
     "snap_in_progress.txt",
 )
 
-MOVE_IMAGES_MAX_DURATION = 5 * 60
+UPLOAD_CONCURRENCY = 3
 
 src_folder = os.path.join(
     os.path.dirname(__file__), "..", "data", "images", "to_send", ""
 )
 
-log_file_handler = logging.FileHandler(
+log_file_handler = BatchFileHandler(
     os.path.join(
         os.path.dirname(__file__),
         "..",
@@ -43,12 +35,11 @@ log_file_handler = logging.FileHandler(
     delay=True,
 )
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="[%(asctime)s - %(name)s - %(levelname)s] - %(message)s",
+log_listener = start_queue_logging(
     handlers=[
         log_file_handler,
     ],
+    level=logging.INFO,
 )
 
 logger = logging.getLogger("file_sender")
@@ -57,113 +48,37 @@ logger.info("____________________Starting filesender___________________")
 logger.info("__________________________________________________________")
 
 
-def send_images():
-    start = timer()
-
-    src_folder = os.path.join(
-        os.path.dirname(__file__),
-        "..",
-        "data",
-        "images",
-        "to_send",
-        "",
-    )
-    sent_folder = os.path.join(
-        os.path.dirname(__file__),
-        "..",
-        "data",
-        "images",
-        "sent",
-        "",
-    )
-
-    if server_conf:
-        p = paramiko.SSHClient()
-        p.set_missing_host_key_policy(paramiko.AutoAddPolicy)
-        p.connect(
-            server_conf["address"],
-            port=server_conf["port"],
-            username=server_conf["user"],
-            password=server_conf["password"],
-        )
-        ftp = p.open_sftp()
-        ftp.chdir("RobotRacine")
-        for name in os.listdir(src_folder):
-            if (timer() - start) >= MOVE_IMAGES_MAX_DURATION:
-                logger.info(
-                    f"Stopping sending images to avoid job conflicts after {(timer() - start) / 60} minutes"
-                )
-                break
-            try:
-                exp_folder = os.path.basename(name).split("#")[1]
-                try:
-                    ftp.stat(exp_folder)
-                except FileNotFoundError:
-                    logger.info(f"Creating {exp_folder} folder")
-                    ftp.mkdir(exp_folder)
-                ftp.put(
-                    os.path.join(src_folder, name),
-                    os.path.join(exp_folder, name),
-                )
-            except Exception as e:
-                logger.error(f"Unable to move {name} because {repr(e)}")
-            else:
-                # Check file size and delete source
-                if (
-                    os.path.getsize(os.path.join(src_folder, name))
-                    == ftp.stat(os.path.join(exp_folder, name)).st_size
-                ):
-                    logger.info(f"Moved {name}, moved source to sent folder")
-                    shutil.move(
-                        os.path.join(src_folder, name),
-                        os.path.join(sent_folder, name),
-                    )
-                else:
-                    logger.error(f"Wrong destination file size: {name}")
-
-        else:
-            logger.info("Ended file sending")
-        ftp.close()
-        p.close()
-    else:
-        # Find the target folder
-        for fld in glob.glob(os.path.join("/", "media", "pi", "*")):
-            if os.path.isdir(os.path.join(fld, "robot_racine", "")):
-                base_target_folder = os.path.join(fld, "robot_racine", "")
-                break
-        else:
-            base_target_folder = ""
-            logger.warning("No target folder found, will not move images")
-        if base_target_folder:
-            for name in os.listdir(src_folder):
-                if (timer() - start) >= MOVE_IMAGES_MAX_DURATION:
-                    logger.info(
-                        f"Stopping sending images to avoid job conflicts after {(timer() - start) / 60} minutes"
-                    )
-                    break
-                try:
-                    # Get experiment name
-                    target_folder = os.path.join(
-                        base_target_folder, os.path.basename(name).split("#")[1]
-                    )
-                    if not os.path.exists(target_folder):
-                        os.makedirs(target_folder)
-
-                    shutil.move(
-                        os.path.join(src_folder, name),
-                        os.path.join(target_folder, name),
-                    )
-                except Exception as e:
-                    logger.error(f"Unable to move {name} because {repr(e)}")
-                else:
-                    logger.info(f"Moved {name}")
-            else:
-                logger.info("Ended file sending")
+def send_images(work_seconds: float = None, concurrency: int = UPLOAD_CONCURRENCY):
+    if work_seconds is None:
+        work_seconds = upload_window()
+    logger.info(f"Upload window of {round(work_seconds)} seconds")
+    send_pending_images(work_seconds=work_seconds, concurrency=concurrency)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send captured images")
+    parser.add_argument(
+        "--duration",
+        type=float,
+        help="Maximum time spent sending images, in seconds",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        help="Time at which sending must be over, as a unix timestamp",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=UPLOAD_CONCURRENCY,
+        help="Number of parallel SFTP channels",
+    )
+    args = parser.parse_args()
+    work_seconds = args.duration
+    if args.deadline is not None:
+        work_seconds = max(args.deadline - dt.now().timestamp(), 0)
     try:
-        send_images()
+        send_images(work_seconds=work_seconds, concurrency=args.jobs)
     except:
         exit(1)
     else:
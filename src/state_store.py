@@ -0,0 +1,250 @@
+import os
+import csv
+import json
+import sqlite3
+import logging
+import argparse
+import threading
+
+logger = logging.getLogger("rr_drive")
+
+# Bumped when the schema changes
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS plants (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    experiment TEXT NOT NULL,
+    plant_name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    allow_capture INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS plants_experiment ON plants (experiment);
+CREATE INDEX IF NOT EXISTS plants_position ON plants (position);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    guid TEXT NOT NULL UNIQUE,
+    data TEXT NOT NULL
+);
+"""
+
+
+class StateStore:
+    """Settings, plants and jobs kept in a SQLite database in WAL mode
+
+    Every change is a small transaction on the rows concerned, so an
+    interrupted write never leaves a truncated file behind. The database is
+    opened on first use.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._connection = None
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def transaction(self):
+        return _Transaction(self)
+
+    @property
+    def is_initialized(self) -> bool:
+        """False until the first import, user_version holds the schema version"""
+        with self._lock:
+            return self.connection.execute("PRAGMA user_version").fetchone()[0] > 0
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    # Settings
+
+    def load_settings(self) -> dict:
+        with self._lock:
+            rows = self.connection.execute("SELECT key, value FROM settings").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_settings(self, settings: dict):
+        with self.transaction() as db:
+            db.executemany(
+                "INSERT INTO settings (key, value) VALUES (?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                [(key, json.dumps(value)) for key, value in settings.items()],
+            )
+
+    # Plants
+
+    def load_plants(self) -> list:
+        """Returns (experiment, plant_name, position, allow_capture) rows"""
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT experiment, plant_name, position, allow_capture"
+                " FROM plants ORDER BY id"
+            ).fetchall()
+        return [(e, p, pos, bool(allow)) for e, p, pos, allow in rows]
+
+    def add_plants(self, rows):
+        with self.transaction() as db:
+            db.executemany(
+                "INSERT INTO plants (experiment, plant_name, position, allow_capture)"
+                " VALUES (?, ?, ?, ?)",
+                [(e, p, int(pos), int(bool(allow))) for e, p, pos, allow in rows],
+            )
+
+    def remove_experiments(self, experiments):
+        with self.transaction() as db:
+            db.executemany(
+                "DELETE FROM plants WHERE experiment = ?",
+                [(experiment,) for experiment in experiments],
+            )
+
+    # Jobs
+
+    def load_jobs(self) -> list:
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT data FROM jobs ORDER BY id"
+            ).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def save_jobs(self, jobs):
+        """Inserts or updates jobs given as to_json dicts, keeping their order"""
+        with self.transaction() as db:
+            db.executemany(
+                "INSERT INTO jobs (guid, data) VALUES (?, ?)"
+                " ON CONFLICT (guid) DO UPDATE SET data = excluded.data",
+                [(job["guid"], json.dumps(job)) for job in jobs],
+            )
+
+    def delete_job(self, guid):
+        with self.transaction() as db:
+            db.execute("DELETE FROM jobs WHERE guid = ?", (guid,))
+
+    # Import and export of the legacy files
+
+    def import_state(self, settings: dict, plants: list, jobs: list):
+        """Replaces the whole state in a single transaction"""
+        with self.transaction() as db:
+            db.execute("DELETE FROM settings")
+            db.execute("DELETE FROM plants")
+            db.execute("DELETE FROM jobs")
+            self.save_settings(settings)
+            self.add_plants(plants)
+            self.save_jobs(jobs)
+            db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+class _Transaction:
+    """Serializes access and wraps the block in BEGIN/COMMIT, nested blocks join
+    the outer transaction"""
+
+    def __init__(self, store: StateStore) -> None:
+        self.store = store
+        self.outer = False
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.store._lock.acquire()
+        connection = self.store.connection
+        self.outer = not connection.in_transaction
+        if self.outer:
+            connection.execute("BEGIN IMMEDIATE")
+        return connection
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self.outer:
+                if exc_type is None:
+                    self.store.connection.execute("COMMIT")
+                else:
+                    self.store.connection.execute("ROLLBACK")
+        finally:
+            self.store._lock.release()
+        return False
+
+
+def read_legacy_files(settings_path, plant_data_path, jobs_file_path, read_plants):
+    """Reads settings.json, plants_data.csv and jobs_data.json, missing files
+    give empty values. read_plants(path) returns the plant rows of a file."""
+    settings = {}
+    if os.path.isfile(settings_path):
+        with open(settings_path, "r") as f:
+            settings = json.load(f)
+    plants = []
+    if os.path.isfile(plant_data_path):
+        plants = read_plants(plant_data_path)
+    jobs = []
+    if os.path.isfile(jobs_file_path):
+        with open(jobs_file_path, "r") as f:
+            jobs = json.load(f)["jobs"]
+    return settings, plants, jobs
+
+
+def write_atomic(path, write):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", newline="") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def export_files(store: StateStore, settings_path, plant_data_path, jobs_file_path):
+    """Writes the store back to the legacy file formats"""
+    write_atomic(
+        settings_path, lambda f: json.dump(store.load_settings(), f, indent=2)
+    )
+
+    def write_plants(f):
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["experiment", "plant_name", "position", "allow_capture"])
+        writer.writerows(store.load_plants())
+
+    write_atomic(plant_data_path, write_plants)
+    write_atomic(
+        jobs_file_path, lambda f: json.dump({"jobs": store.load_jobs()}, f, indent=2)
+    )
+
+
+if __name__ == "__main__":
+    from drive import (
+        jobs_file_path,
+        plant_data_path,
+        read_plant_rows,
+        settings_path,
+        state_db_path,
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Copy the state between the database and the json/csv files"
+    )
+    parser.add_argument("command", choices=["import", "export"])
+    args = parser.parse_args()
+
+    store = StateStore(state_db_path)
+    if args.command == "import":
+        store.import_state(
+            *read_legacy_files(
+                settings_path, plant_data_path, jobs_file_path, read_plant_rows
+            )
+        )
+        print(f"Imported files into {state_db_path}")
+    else:
+        export_files(store, settings_path, plant_data_path, jobs_file_path)
+        print(f"Exported {state_db_path} to files")
@@ -13,6 +13,8 @@ import psutil
 from datetime import datetime as dt
 import json
 
+from log_store import BatchFileHandler, start_queue_logging
+
 
 class MemoryFilter(logging.Filter):
 
@@ -29,7 +31,7 @@ class MemoryFilter(logging.Filter):
         return True
 
 
-log_file_handler = logging.FileHandler(
+log_file_handler = BatchFileHandler(
     os.path.join(
         os.path.dirname(__file__),
         "..",
@@ -45,13 +47,18 @@ log_stdout_handler = logging.StreamHandler(sys.stdout)
 log_stdout_handler.addFilter(MemoryFilter())
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="[%(asctime)s - %(mem_data)s - %(name)s - %(levelname)s] - %(message)s",
+log_formatter = logging.Formatter(
+    "[%(asctime)s - %(mem_data)s - %(name)s - %(levelname)s] - %(message)s"
+)
+log_stdout_handler.setFormatter(log_formatter)
+log_file_handler.setFormatter(log_formatter)
+
+log_listener = start_queue_logging(
     handlers=[
         log_stdout_handler,
         log_file_handler,
     ],
+    level=logging.INFO,
 )
 
 logger = logging.getLogger("test_server")
@@ -0,0 +1,104 @@
+import os
+import sys
+import logging
+import importlib.util
+from multiprocessing import get_context
+
+logger = logging.getLogger("rr_drive")
+
+# Format captured by PiCamera and extension of the stored file
+CAPTURE_FORMATS = {
+    "png": ".png",
+    "jpeg": ".jpg",
+    "bmp": ".bmp",
+    "rgb": ".rgb",
+    "yuv": ".yuv",
+}
+
+# Lossless formats produced from a raw rgb capture by the process pool
+DEFERRED_FORMATS = {
+    "png": ".png",
+    "webp": ".webp",
+}
+
+
+def pillow_available() -> bool:
+    return importlib.util.find_spec("PIL") is not None
+
+
+def raw_frame_size(width: int, height: int):
+    """PiCamera pads raw captures to a multiple of 32 columns and 16 rows"""
+    return (width + 31) // 32 * 32, (height + 15) // 16 * 16
+
+
+def transcode_raw(raw_path, temp_path, width: int, height: int, fmt: str):
+    """Runs in a pool process, encodes a raw rgb capture to temp_path"""
+    from PIL import Image
+
+    with open(raw_path, "rb") as f:
+        data = f.read()
+    image = Image.frombuffer(
+        "RGB", raw_frame_size(width, height), data, "raw", "RGB", 0, 1
+    ).crop((0, 0, width, height))
+    if fmt == "webp":
+        image.save(temp_path, format="WEBP", lossless=True, method=4)
+    else:
+        image.save(temp_path, format="PNG", compress_level=6)
+    os.remove(raw_path)
+    return temp_path
+
+
+class Transcoder:
+    """Encodes raw captures to lossless formats on all the cores
+
+    The pool should be started when the UI starts, it is created on first use
+    otherwise. Its processes are spawned so that they don't inherit the
+    threads and locks of the UI. on_done is called from the pool's result
+    thread once the encoded file is ready.
+    """
+
+    def __init__(self, processes: int = None) -> None:
+        self.processes = processes or os.cpu_count() or 1
+        self._pool = None
+
+    def start(self):
+        if self._pool is not None:
+            return
+        # Spawned processes import the main module first, have them import this
+        # one instead of running the whole UI again
+        main = sys.modules["__main__"]
+        main_spec = getattr(main, "__spec__", None)
+        main.__spec__ = importlib.util.find_spec(__name__)
+        try:
+            self._pool = get_context("spawn").Pool(processes=self.processes)
+        finally:
+            main.__spec__ = main_spec
+
+    def submit(self, raw_path, temp_path, width, height, fmt, on_done, on_error):
+        self.start()
+        self._pool.apply_async(
+            transcode_raw,
+            (raw_path, temp_path, width, height, fmt),
+            callback=on_done,
+            error_callback=on_error,
+        )
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def remove_orphans(folder) -> int:
+    """Removes the raw captures and encoded temp files left by a crash"""
+    removed = 0
+    for name in os.listdir(folder):
+        if name.startswith(".") and name.endswith((".raw", ".tmp")):
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError as e:
+                logger.warning(f"Unable to remove {name} because {repr(e)}")
+            else:
+                removed += 1
+    return removed
@@ -3,55 +3,88 @@ import logging
 from datetime import datetime as dt
 from datetime import timedelta as td
 import subprocess
+import threading
 from multiprocessing import Process
 from timeit import default_timer as timer
 import glob
 
 
-lesser_log = []
+class StartupProfile:
+    """Durations of the startup stages, reported once the first frame is drawn"""
 
+    def __init__(self) -> None:
+        self.origin = timer()
+        self.last = self.origin
+        self.stages = []
 
-class LesserFilter(logging.Filter):
+    def mark(self, stage: str):
+        now = timer()
+        self.stages.append((stage, now - self.last))
+        self.last = now
 
-    last_process_mem = 0
+    @property
+    def total(self) -> float:
+        return self.last - self.origin
 
-    def filter(self, record):
-        if record.name in ["robot_racine", "rr_drive"]:
-            lesser_log.append(
-                f"[{dt.now().strftime('%Y/%m/%d %H:%M:%S')} - {record.name} - {record.levelname}] {record.msg}"
+    def report(self) -> str:
+        return ", ".join(
+            [f"{stage}: {duration:.3f}s" for stage, duration in self.stages]
+            + [f"total: {self.total:.3f}s"]
+        )
+
+    def save(self, path):
+        """Appends one line per startup to track time to first frame"""
+        write_header = not os.path.isfile(path)
+        with open(path, "a") as f:
+            if write_header:
+                f.write("timestamp,total," + ",".join(s for s, _ in self.stages) + "\n")
+            f.write(
+                ",".join(
+                    [dt.now().strftime("%Y/%m/%d %H:%M:%S"), f"{self.total:.3f}"]
+                    + [f"{duration:.3f}" for _, duration in self.stages]
+                )
+                + "\n"
             )
-        return True
 
 
-log_file_handler = logging.FileHandler(
-    os.path.join(
-        os.path.dirname(__file__),
-        "..",
-        "logs",
-        f"robot_racine_{dt.now().strftime('%Y%m%d')}.log",
-    ),
-    mode="a",
-    delay=True,
+startup_profile = StartupProfile()
+
+from log_store import (
+    LEVEL_FILTERS,
+    DailyFileHandler,
+    LogStore,
+    LogStoreHandler,
+    start_queue_logging,
+)
+
+LOG_STORE_CAPACITY = 5000
+LOG_PAGE_SIZE = 100
+
+log_store = LogStore(
+    capacity=LOG_STORE_CAPACITY, names=["robot_racine", "rr_drive", "rr_upload"]
+)
+
+
+log_file_handler = DailyFileHandler(
+    folder=os.path.join(os.path.dirname(__file__), "..", "logs"),
+    prefix="robot_racine",
 )
-log_file_handler.addFilter(LesserFilter())
 
-logging.basicConfig(
+log_listener = start_queue_logging(
+    handlers=[log_file_handler, LogStoreHandler(store=log_store)],
     level=logging.DEBUG,
-    format="[%(asctime)s - %(name)s - %(levelname)s] - %(message)s",
-    handlers=[log_file_handler],
 )
 
 logger = logging.getLogger("robot_racine")
 logger.info("__________________________________________________________")
 logger.info("__________________Starting robot racine___________________")
 logger.info("__________________________________________________________")
+startup_profile.mark("logging")
 
 
 from uuid import uuid4
 from functools import partial
 
-import pandas as pd
-
 from kivy.app import App
 from kivy.uix.screenmanager import ScreenManager, Screen
 from kivy.config import Config
@@ -65,20 +98,36 @@ from kivy.uix.label import Label
 from kivy.uix.modalview import ModalView
 from kivy.clock import Clock
 
-from drive import Controller, JobData, JobState, USE_SEND_IMAGES_SCRIPT
+startup_profile.mark("import kivy")
+
+from log_archive import rotate_logs
+from drive import (
+    Controller,
+    IncrementalFilter,
+    JobData,
+    JobState,
+    USE_SEND_IMAGES_SCRIPT,
+)
+
+startup_profile.mark("import drive")
 
 
 controller: Controller = Controller()
-controller.send_command(
-    command="stop",
-    callback=None,
-)
+startup_profile.mark("controller")
 
 Config.set("graphics", "borderless", "1")
 Config.set("graphics", "window_state", "maximized")
 
 
-MOVE_IMAGES_MIN_INTERVAL = 6 * 60
+# Closed log days are archived this often while the UI runs
+LOG_ROTATION_INTERVAL = 24 * 3600
+# How often the UI checks whether send_images.py should be launched
+UPLOAD_CHECK_INTERVAL = 60
+COUNTDOWN_INTERVAL = 0.5
+# Launch timers are re-checked at least this often to absorb wall clock changes
+MAX_LAUNCH_ARM_DELAY = 60
+# A launch timer firing this early is considered on time
+LAUNCH_TOLERANCE = 0.02
 
 
 class RootWidget(BoxLayout):
@@ -140,9 +189,12 @@ class MyPageManager(ScreenManager):
         super(MyPageManager, self).__init__(**kwargs)
         self.countdown_event = Clock.schedule_interval(
             self.update_countdown,
-            0.1,
+            COUNTDOWN_INTERVAL,
         )
-        self.last_time_sending_image = timer() - MOVE_IMAGES_MIN_INTERVAL
+        self.launch_event = None
+        self.last_time_sending_image = timer() - UPLOAD_CHECK_INTERVAL
+        controller.scheduler.on_change = self.arm_next_job
+        self.arm_next_job()
 
     def on_back(self):
         self.current_screen.back()
@@ -216,44 +268,82 @@ class MyPageManager(ScreenManager):
             and controller.job_in_progress.state == JobState.ENDED
         ):
             self.limit_interractivity(limit_ui=False)
-            controller.path_for_send_lock.unlink()
+            controller.when_captures_stored(self.remove_send_lock)
             subprocess.call("xset +dpms", shell=True)
 
         if update_captured_image is True:
             self.get_screen("capture").captured_image.reload()
 
+    def remove_send_lock(self):
+        lock = controller.path_for_send_lock
+        if controller.job_in_progress is None and lock.exists():
+            lock.unlink()
+
     def delayed_update_status(self, message, dt):
         self.lbl_status.text = message
         return False
 
-    def launch_job(self, job):
-        if job is None:
+    def launch_job(self, job, fire_time=None):
+        self.launch_jobs(entries=[] if job is None else [(fire_time, job)])
+
+    def launch_jobs(self, entries):
+        if not entries:
             logger.warning("No job to launch")
         else:
             controller.path_for_send_lock.touch()
             subprocess.call("xset dpms force on", shell=True)
             self.set_active_page(new_page_name="start_up", direction="right")
             self.limit_interractivity(limit_ui=True)
-            controller.execute_job(job, self.update_status)
+            controller.execute_jobs(entries, self.update_status)
+
+    def arm_next_job(self):
+        """Arms a single timer for the exact fire time of the next job"""
+        if self.launch_event is not None:
+            self.launch_event.cancel()
+            self.launch_event = None
+        next_fire = controller.scheduler.peek()
+        if next_fire is None:
+            return
+        fire_time, job = next_fire
+        delay = (fire_time - dt.now()).total_seconds()
+        self.launch_event = Clock.schedule_once(
+            partial(self.on_job_due, fire_time, job),
+            min(max(delay, 0), MAX_LAUNCH_ARM_DELAY),
+        )
+
+    def on_job_due(self, fire_time, job, delta):
+        self.launch_event = None
+        if (fire_time - dt.now()).total_seconds() > LAUNCH_TOLERANCE:
+            self.arm_next_job()
+        elif controller.job_in_progress is not None:
+            logger.warning(
+                f"Skipped job {job.name} because {controller.job_in_progress.name} is in progress"
+            )
+            controller.scheduler.fired(job=job, fire_time=fire_time)
+        else:
+            window = controller.settings.get("coalesce_window", 0)
+            if window > 0:
+                entries = controller.scheduler.due_within(
+                    window=window, fire_time=fire_time, job=job
+                )
+            else:
+                entries = [(fire_time, job)]
+            self.launch_jobs(entries=entries)
 
     def update_countdown(self, delta):
         if controller.job_in_progress is None:
             self.pg_global.value = 0
-            next_job = controller.get_next_job()
-            if next_job:
+            next_fire = controller.scheduler.peek()
+            if next_fire is not None:
+                fire_time, next_job = next_fire
                 count_down_text = ""
-                td_next = next_job.next_time_point - dt.now()
+                td_next = fire_time - dt.now()
                 if td_next.days < 1 and td_next.seconds < 11:
-                    move_pictures = False
-                    if td_next.seconds > 0.5:
-                        self.lbl_info.text = self.format_text(
-                            f"Next job {next_job.name} WILL start in {td_next.seconds}{'  ' * round(td_next.seconds)} >",
-                            is_bold=True,
-                            font_size=20,
-                        )
-                    else:
-                        self.launch_job(job=next_job)
-
+                    self.lbl_info.text = self.format_text(
+                        f"Next job {next_job.name} WILL start in {td_next.seconds}{'  ' * round(td_next.seconds)} >",
+                        is_bold=True,
+                        font_size=20,
+                    )
                 else:
                     count_down_text += f"{td_next.days} days "
                     hours, remainder = divmod(td_next.seconds, 3600)
@@ -264,14 +354,11 @@ class MyPageManager(ScreenManager):
                     self.lbl_info.text = (
                         f"Next job {next_job.name} starts in {count_down_text}"
                     )
-                    move_pictures = minutes * 60 >= MOVE_IMAGES_MIN_INTERVAL
             else:
                 self.lbl_info.text = "No job in schedule"
-                move_pictures = True
             if (
                 USE_SEND_IMAGES_SCRIPT
-                and move_pictures
-                and (timer() - self.last_time_sending_image) > MOVE_IMAGES_MIN_INTERVAL
+                and (timer() - self.last_time_sending_image) > UPLOAD_CHECK_INTERVAL
             ):
                 self.last_time_sending_image = timer()
                 controller.start_send_tool(self.update_status)
@@ -399,27 +486,29 @@ class PlantSelector(ModalView):
 
     available_plants = ObjectProperty(None)
     selected_plants = ObjectProperty(None)
-    selected_plants_list = []
     job = None
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.selection = set()
+        self.plant_filter = IncrementalFilter()
+
     def update_list_views(self):
+        shown = self.plant_filter(
+            controller.plant_data.plant_names(), self.ids["plant_filter"].text
+        )
         self.ids["available_plants"].data = [
-            {"text": j}
-            for j in [
-                plant
-                for plant in controller.plant_data.plant_name.unique()
-                if plant not in self.selected_plants_list
-            ]
+            {"text": plant} for plant in shown if plant not in self.selection
         ]
         self.ids["selected_plants"].data = [
-            {"text": j} for j in self.selected_plants_list
+            {"text": plant} for plant in sorted(self.selection)
         ]
 
     def add_to_selection(self):
         selected_nodes = self.ids["available_plants"].layout_manager.selected_nodes
         self.ids["available_plants"].layout_manager.selected_nodes = []
         if selected_nodes:
-            self.selected_plants_list.extend(
+            self.selection.update(
                 [self.ids["available_plants"].data[i]["text"] for i in selected_nodes]
             )
             self.update_list_views()
@@ -431,9 +520,7 @@ class PlantSelector(ModalView):
         ]
         self.ids["selected_plants"].layout_manager.selected_nodes = []
         if selected_nodes:
-            self.selected_plants_list = [
-                p for p in self.selected_plants_list if p not in selected_nodes
-            ]
+            self.selection.difference_update(selected_nodes)
             self.update_list_views()
 
 
@@ -472,7 +559,7 @@ class JobsManage(MyScreen):
             return -1
 
     def new_job(self):
-        controller.jobs_data.append(
+        controller.add_job(
             JobData(
                 **{
                     "name": "Job " + dt.now().strftime("%Y%m%d %H:%M:%S"),
@@ -487,11 +574,9 @@ class JobsManage(MyScreen):
                     "timestamp_end": (dt.now() + td(days=14)).strftime(
                         "%Y/%m/%d %H:%M:%S"
                     ),
-                    "plants": controller.plant_data[
-                        controller.plant_data.allow_capture == True
-                    ]
-                    .plant_name.unique()
-                    .tolist(),
+                    "plants": list(
+                        controller.plant_data.plant_names(capturable_only=True)
+                    ),
                 }
             )
         )
@@ -554,6 +639,7 @@ class JobsManage(MyScreen):
             rep_mode=self.time_mode.text,
             rep_value=rep_val,
         )
+        controller.update_job(controller.jobs_data[index])
 
     def toggle_job_state(self, guid):
         job = self.get_job(guid=guid)
@@ -567,6 +653,7 @@ class JobsManage(MyScreen):
             self.state_image_button.image_path = "../resources/active.png"
             job.enabled = True
             self.state_image_button.lbl_text = "Enabled"
+        controller.update_job(job)
         self.update_data(guid=guid)
 
     def start_job(self, guid):
@@ -576,7 +663,7 @@ class JobsManage(MyScreen):
         index = self.get_job_index(guid=guid)
         if index < 0:
             return
-        controller.jobs_data.pop(index)
+        controller.delete_job(index)
         self.init_jobs()
         if len(controller.jobs_data) > 0:
             self.update_data(guid=controller.jobs_data[-1].guid)
@@ -587,6 +674,7 @@ class JobsManage(MyScreen):
         if instance.modal_result == 1:
             current_plants = [d["text"] for d in instance.ids["selected_plants"].data]
             instance.job.plants = current_plants
+            controller.update_job(instance.job)
             self.update_data(guid=instance.job.guid)
         return False
 
@@ -595,10 +683,7 @@ class JobsManage(MyScreen):
         if job is None:
             return
         self.plant_selector = PlantSelector()
-        pl = job.plants[:]
-        if not pl:
-            pl = []
-        self.plant_selector.selected_plants_list = pl
+        self.plant_selector.selection = set(job.plants or [])
         self.plant_selector.job = job
         self.plant_selector.update_list_views()
         self.plant_selector.bind(on_dismiss=self.close_plant_selection)
@@ -611,8 +696,34 @@ class JobsLog(MyScreen):
     title_text = "Logs"
     info_text = "Logs, logs everywhere"
 
+    page_index = 0
+    page_count = 1
+
     def init_logs(self):
-        self.log_text.text = "\n".join(reversed(lesser_log))
+        self.page_index = 0
+        self.update_page()
+
+    def update_page(self):
+        lines, self.page_count = log_store.page(
+            index=self.page_index,
+            page_size=LOG_PAGE_SIZE,
+            min_level=LEVEL_FILTERS.get(self.ids["log_level"].text, logging.NOTSET),
+        )
+        self.page_index = min(self.page_index, self.page_count - 1)
+        self.ids["log_lines"].data = [{"text": line} for line in lines]
+        self.ids["log_lines"].scroll_y = 1
+        self.ids["page_label"].text = f"Page {self.page_index + 1}/{self.page_count}"
+
+    def change_page(self, step: int):
+        self.page_index = min(max(self.page_index + step, 0), self.page_count - 1)
+        self.update_page()
+
+    def set_level(self):
+        if "log_lines" not in self.ids:
+            # Spinner text set while the screen is being built
+            return
+        self.page_index = 0
+        self.update_page()
 
 
 class FileLoader(ModalView):
@@ -629,24 +740,50 @@ class DataIn(MyScreen):
     experiments_list = ObjectProperty(None)
     plants_list = ObjectProperty(None)
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.current_experiment = None
+        self.plant_filter = IncrementalFilter()
+
     def init_experiments(self):
         self.experiments_list.data = [
-            {"text": j} for j in controller.plant_data.experiment.unique()
+            {"text": j} for j in controller.plant_data.experiments()
         ]
 
     def close_file_selection(self, instance):
         if instance.modal_result == 1:
             try:
-                new_df = pd.read_csv(instance.ids["file_name"].text).dropna()
+                report = controller.import_plant_data(
+                    path=instance.ids["file_name"].text
+                )
             except Exception as e:
                 logger.error(f"Failed to load data in because {repr(e)}")
             else:
-                controller.plant_data = pd.concat(
-                    (controller.plant_data, new_df)
-                ).drop_duplicates()
-                self.init_experiments()
+                self.manager.update_status(
+                    report.summary(),
+                    wipe_after=10,
+                    log_level=logging.WARNING if report.issues else logging.INFO,
+                )
+                for issue in report.issues:
+                    logger.warning(issue)
+                if report.issues:
+                    self.show_import_issues(report)
+                if report.added:
+                    self.init_experiments()
         return False
 
+    def show_import_issues(self, report, max_lines: int = 8):
+        issues = report.issues
+        body = issues[:max_lines]
+        if len(issues) > max_lines:
+            body.append(f"... and {len(issues) - max_lines} more, see the log")
+        self.modal_dialog = ModalDialog()
+        self.modal_dialog.modal_dialog_title.text = self.manager.format_text(
+            text=report.summary(), is_bold=False, font_size=0
+        )
+        self.modal_dialog.modal_dialog_body.text = "\n".join(body)
+        self.modal_dialog.open()
+
     def load_file(self):
         self.file_loader = FileLoader()
         for fld in glob.glob(os.path.join("/", "media", "pi", "*")):
@@ -661,27 +798,30 @@ class DataIn(MyScreen):
         self.file_loader.open()
 
     def update_plants(self, experiment):
-        if experiment:
+        self.current_experiment = experiment
+        self.filter_plants()
+
+    def filter_plants(self):
+        if self.current_experiment:
             self.plants_list.data = [
-                {"text": j}
-                for j in controller.plant_data[
-                    controller.plant_data.experiment == experiment
-                ].plant_name
+                {"text": plant}
+                for plant in self.plant_filter(
+                    controller.plant_data.plant_names_of(self.current_experiment),
+                    self.ids["plant_filter"].text,
+                )
             ]
         else:
             self.plants_list.data = []
 
     def remove_experiment(self):
-        controller.plant_data = controller.plant_data[
-            ~controller.plant_data.experiment.isin(
-                [
-                    self.ids["experiments_list"].data[i]["text"]
-                    for i in self.ids["experiments_list"].layout_manager.selected_nodes
-                ]
-            )
-        ]
+        controller.remove_experiments(
+            [
+                self.ids["experiments_list"].data[i]["text"]
+                for i in self.ids["experiments_list"].layout_manager.selected_nodes
+            ]
+        )
         self.ids["experiments_list"].layout_manager.selected_nodes = []
-        self.plants_list.data = []
+        self.update_plants(experiment=None)
         self.init_experiments()
 
 
@@ -715,7 +855,53 @@ class RobotRacineApp(App):
     title = "RobotRacine"
 
     def build(self):
-        return RootWidget()
+        startup_profile.mark("kivy init")
+        root = RootWidget()
+        startup_profile.mark("build")
+        return root
+
+    def on_start(self):
+        startup_profile.mark("on start")
+        controller.send_command(
+            command="stop",
+            callback=None,
+        )
+        Clock.schedule_once(self.report_startup)
+        self.start_log_rotation()
+        Clock.schedule_interval(self.start_log_rotation, LOG_ROTATION_INTERVAL)
+        if not USE_SEND_IMAGES_SCRIPT:
+            # Images left unsent by the previous sessions go out right away
+            controller.upload_worker.start()
+        try:
+            controller.start_transcoder()
+        except Exception as e:
+            logger.error(f"Failed to start the transcoder because {repr(e)}")
+
+    def on_stop(self):
+        controller.transcoder.close()
+
+    def start_log_rotation(self, *args):
+        threading.Thread(
+            target=self.rotate_logs, name="log_rotation", daemon=True
+        ).start()
+
+    def rotate_logs(self):
+        try:
+            rotate_logs(exclude=[log_file_handler.baseFilename])
+        except Exception as e:
+            logger.error(f"Failed to rotate logs because {repr(e)}")
+
+    def report_startup(self, *args):
+        startup_profile.mark("first frame")
+        logger.info(f"Startup times - {startup_profile.report()}")
+        try:
+            startup_profile.save(
+                os.path.join(
+                    os.path.dirname(__file__), "..", "logs", "startup_times.csv"
+                )
+            )
+        except Exception as e:
+            logger.error(f"Failed to save startup times because {repr(e)}")
 
 
 if __name__ == "__main__":
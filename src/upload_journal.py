@@ -0,0 +1,274 @@
+import os
+import json
+import time
+import fcntl
+import heapq
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger("rr_upload")
+
+journal_path = os.path.join(
+    os.path.dirname(__file__), "..", "data", "images", "upload_journal.jsonl"
+)
+
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+RETRY_BASE_DELAY = 60
+RETRY_MAX_DELAY = 6 * 3600
+# Journal is rewritten when it holds this many more lines than live items
+COMPACT_SLACK = 1000
+
+
+class JournalBusy(Exception):
+    """Another process owns the upload journal"""
+
+
+class JournalItem:
+    __slots__ = ("file_name", "state", "attempts", "next_retry", "error")
+
+    def __init__(
+        self, file_name, state=PENDING, attempts=0, next_retry=0.0, error=""
+    ) -> None:
+        self.file_name = file_name
+        self.state = state
+        self.attempts = attempts
+        self.next_retry = next_retry
+        self.error = error
+
+    def to_json(self) -> dict:
+        return {
+            "file_name": self.file_name,
+            "state": self.state,
+            "attempts": self.attempts,
+            "next_retry": self.next_retry,
+            "error": self.error,
+            "time": time.time(),
+        }
+
+
+def retry_delay(attempts: int) -> float:
+    return min(RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0), RETRY_MAX_DELAY)
+
+
+class UploadJournal:
+    """Persistent upload queue, every state change is a line appended to a file
+
+    Items ready to be sent are kept in a deque and dequeued in O(1), failed
+    items wait in a heap ordered by their next retry time. Replaying the file
+    gives back the queue after a restart, items that were in flight are sent
+    again, the uploader resumes and checks them. Only one process at a time
+    can own the journal.
+    """
+
+    def __init__(self, path=journal_path) -> None:
+        self.path = path
+        self._items = {}
+        self._ready = deque()
+        self._waiting = []
+        self._lock = threading.RLock()
+        self._file = None
+        self._lock_file = None
+        self._lines = 0
+
+    def open(self):
+        with self._lock:
+            if self._file is not None:
+                return self
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._lock_file = open(self.path + ".lock", "w")
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lock_file.close()
+                self._lock_file = None
+                raise JournalBusy(f"{self.path} is used by another process")
+            self._replay()
+            if self._lines > len(self._items) + COMPACT_SLACK:
+                self._compact()
+            self._file = open(self.path, "a")
+            return self
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._lock_file is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                self._lock_file.close()
+                self._lock_file = None
+
+    def _replay(self):
+        self._items = {}
+        self._lines = 0
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
+                    self._lines += 1
+                    try:
+                        data = json.loads(line)
+                        item = JournalItem(
+                            file_name=data["file_name"],
+                            state=data["state"],
+                            attempts=data.get("attempts", 0),
+                            next_retry=data.get("next_retry", 0.0),
+                            error=data.get("error", ""),
+                        )
+                    except (ValueError, KeyError):
+                        # Line cut by a power loss
+                        continue
+                    if item.state == DONE:
+                        self._items.pop(item.file_name, None)
+                    else:
+                        self._items[item.file_name] = item
+        self._ready = deque()
+        self._waiting = []
+        for item in self._items.values():
+            if item.state == IN_FLIGHT:
+                item.state = PENDING
+            self._schedule(item)
+
+    def _compact(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            for item in self._items.values():
+                f.write(json.dumps(item.to_json()) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self._lines = len(self._items)
+        logger.info(f"Upload journal compacted to {self._lines} items")
+
+    def _append(self, item: JournalItem):
+        self._file.write(json.dumps(item.to_json()) + "\n")
+        self._file.flush()
+        self._lines += 1
+
+    def _schedule(self, item: JournalItem):
+        if item.state == PENDING:
+            self._ready.append(item.file_name)
+        elif item.state == FAILED:
+            heapq.heappush(self._waiting, (item.next_retry, item.file_name))
+
+    def _promote(self, now):
+        while self._waiting and self._waiting[0][0] <= now:
+            _, file_name = heapq.heappop(self._waiting)
+            item = self._items.get(file_name)
+            if item is not None and item.state == FAILED:
+                item.state = PENDING
+                self._ready.append(file_name)
+
+    def add(self, file_name) -> bool:
+        """Queues a file, returns False if it is already queued"""
+        with self._lock:
+            if file_name in self._items:
+                return False
+            item = JournalItem(file_name=file_name)
+            self._items[file_name] = item
+            self._append(item)
+            self._schedule(item)
+            return True
+
+    def sync(self, file_names) -> int:
+        """Queues the files not in the journal yet, returns how many were added"""
+        with self._lock:
+            return sum(1 for name in file_names if self.add(name))
+
+    def dequeue(self, now=None, accept=None):
+        """Returns the next file ready to be sent and marks it in flight
+
+        If accept(file_name) is given and returns False the file stays at the
+        head of the queue, nothing is written, and None is returned.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._promote(now)
+            while self._ready:
+                file_name = self._ready.popleft()
+                item = self._items.get(file_name)
+                if item is None or item.state != PENDING:
+                    continue
+                if accept is not None and not accept(file_name):
+                    self._ready.appendleft(file_name)
+                    return None
+                item.state = IN_FLIGHT
+                self._append(item)
+                return file_name
+            return None
+
+    def complete(self, file_name):
+        with self._lock:
+            item = self._items.pop(file_name, None)
+            if item is not None:
+                item.state = DONE
+                self._append(item)
+            if self._lines > len(self._items) + COMPACT_SLACK:
+                self._file.close()
+                self._compact()
+                self._file = open(self.path, "a")
+
+    def fail(self, file_name, error: str = "", now=None):
+        """Puts a file back in the queue after an exponential backoff"""
+        now = time.time() if now is None else now
+        with self._lock:
+            item = self._items.get(file_name)
+            if item is None:
+                return
+            item.attempts += 1
+            item.state = FAILED
+            item.error = error
+            item.next_retry = now + retry_delay(item.attempts)
+            self._append(item)
+            self._schedule(item)
+
+    def release(self, file_name):
+        """Puts an in flight file back at the end of the queue without a penalty"""
+        with self._lock:
+            item = self._items.get(file_name)
+            if item is not None and item.state == IN_FLIGHT:
+                item.state = PENDING
+                self._append(item)
+                self._schedule(item)
+
+    @property
+    def ready_count(self) -> int:
+        with self._lock:
+            self._promote(time.time())
+            return sum(
+                1
+                for name in self._ready
+                if name in self._items and self._items[name].state == PENDING
+            )
+
+    def next_retry_in(self, now=None):
+        """Seconds until the next failed item can be retried, None if none"""
+        now = time.time() if now is None else now
+        with self._lock:
+            if not self._waiting:
+                return None
+            return max(self._waiting[0][0] - now, 0)
+
+    def __len__(self):
+        return len(self._items)
+
+    def failed(self) -> list:
+        with self._lock:
+            return [i for i in self._items.values() if i.state == FAILED]
+
+
+_shared_journal = None
+_shared_lock = threading.Lock()
+
+
+def get_journal() -> UploadJournal:
+    """Journal of the process, opened on first use, raises JournalBusy"""
+    global _shared_journal
+    with _shared_lock:
+        if _shared_journal is None:
+            _shared_journal = UploadJournal().open()
+        return _shared_journal
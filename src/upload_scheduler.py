@@ -0,0 +1,89 @@
+import os
+import json
+import logging
+import threading
+from datetime import datetime as dt
+
+logger = logging.getLogger("rr_upload")
+
+rate_path = os.path.join(
+    os.path.dirname(__file__), "..", "data", "images", "upload_rate.json"
+)
+
+# Used until a first upload has been measured, bytes per second
+DEFAULT_RATE = 256 * 1024
+# The estimate never goes below this, so that a slow sample can't stop all sends
+MIN_RATE = 16 * 1024
+# Weight of the last measure in the running estimate
+RATE_SMOOTHING = 0.2
+# Uploads must be over this long before the next sweep starts
+SWEEP_MARGIN = 60
+# Shorter windows are not worth starting a sender
+MIN_UPLOAD_WINDOW = 60
+# Windows are capped so that jobs added in the meantime are taken into account
+MAX_UPLOAD_WINDOW = 30 * 60
+
+
+class ThroughputEstimate:
+    """Running estimate of the upload speed, in bytes per second
+
+    Each file transfer updates an exponentially weighted average starting from
+    DEFAULT_RATE, bounded by MIN_RATE. The estimate is saved after each update
+    so that the UI and send_images.py share it.
+    """
+
+    def __init__(self, path=rate_path) -> None:
+        self.path = path
+        self.rate = DEFAULT_RATE
+        self.samples = 0
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                self.rate = max(float(data["rate"]), MIN_RATE)
+                self.samples = int(data["samples"])
+            except Exception as e:
+                logger.warning(f"Unable to read upload rate because {repr(e)}")
+
+    def add(self, size: int, seconds: float):
+        if size <= 0 or seconds <= 0:
+            return
+        sample = size / seconds
+        with self._lock:
+            self.rate = max(
+                RATE_SMOOTHING * sample + (1 - RATE_SMOOTHING) * self.rate, MIN_RATE
+            )
+            self.samples += 1
+            try:
+                temp_path = self.path + ".tmp"
+                with open(temp_path, "w") as f:
+                    json.dump({"rate": self.rate, "samples": self.samples}, f)
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                logger.warning(f"Unable to save upload rate because {repr(e)}")
+
+    def seconds_for(self, size: int) -> float:
+        return size / self.rate
+
+
+_shared_estimate = None
+_shared_lock = threading.Lock()
+
+
+def get_throughput_estimate() -> ThroughputEstimate:
+    global _shared_estimate
+    with _shared_lock:
+        if _shared_estimate is None:
+            _shared_estimate = ThroughputEstimate()
+        return _shared_estimate
+
+
+def upload_window(next_fire: dt = None, moment: dt = None) -> float:
+    """Seconds available to send images before the next sweep, next_fire is
+    the fire time of the next job, None if there is none"""
+    if next_fire is None:
+        return MAX_UPLOAD_WINDOW
+    moment = dt.now() if moment is None else moment
+    available = (next_fire - moment).total_seconds() - SWEEP_MARGIN
+    return min(max(available, 0), MAX_UPLOAD_WINDOW)
@@ -0,0 +1,648 @@
+import os
+import logging
+import shutil
+import glob
+import threading
+import time
+import hashlib
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+from typing import TYPE_CHECKING
+
+from catalogue import UPLOAD_MISSING, UPLOAD_SENT, UPLOAD_USB, get_catalogue
+from upload_journal import JournalBusy, UploadJournal, get_journal
+from upload_scheduler import get_throughput_estimate
+
+if TYPE_CHECKING:
+    import paramiko
+
+try:
+    from server_credentials import connection_data
+except Exception as e:
+    server_conf = {}
+else:
+    server_conf = connection_data.get("phenopsis", {})
+
+logger = logging.getLogger("rr_upload")
+
+
+def find_usb_target_folder():
+    for fld in glob.glob(os.path.join("/", "media", "pi", "*")):
+        if os.path.isdir(os.path.join(fld, "robot_racine", "")):
+            return os.path.join(fld, "robot_racine", "")
+    else:
+        logger.warning("No target folder found, will not move images")
+        return ""
+
+
+images_folder = os.path.join(os.path.dirname(__file__), "..", "data", "images")
+
+UPLOAD_CHUNK_SIZE = 32768
+
+
+class SftpSession:
+    """Keeps one authenticated SSH transport alive for all the uploads
+
+    The transport is checked before each use and transparently re-opened
+    with an exponential backoff. Experiment folders known to exist on the
+    server are cached so that they are only checked once per connection.
+    """
+
+    def __init__(
+        self,
+        conf: dict = None,
+        base_folder: str = "RobotRacine",
+        max_attempts: int = 4,
+        max_backoff: float = 30,
+    ) -> None:
+        self.conf = server_conf if conf is None else conf
+        self.base_folder = base_folder
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self._client = None
+        self._sftp = None
+        self._known_folders = set()
+        self._hash_failures = set()
+        self._lock = threading.RLock()
+
+    @property
+    def is_healthy(self) -> bool:
+        if self._client is None or self._sftp is None:
+            return False
+        transport = self._client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _connect_once(self):
+        import paramiko
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy)
+        client.connect(
+            self.conf["address"],
+            port=self.conf["port"],
+            username=self.conf["user"],
+            password=self.conf["password"],
+        )
+        client.get_transport().set_keepalive(30)
+        sftp = client.open_sftp()
+        sftp.chdir(self.base_folder)
+        return client, sftp
+
+    def connect(self):
+        self.close()
+        delay = 1
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self._client, self._sftp = self._connect_once()
+            except Exception as e:
+                logger.warning(
+                    f"SFTP connection attempt {attempt} failed because {repr(e)}"
+                )
+                if attempt == self.max_attempts:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+            else:
+                logger.info(f"SFTP connection to {self.conf['address']} established")
+                return
+
+    @property
+    def sftp(self) -> "paramiko.SFTPClient":
+        with self._lock:
+            if not self.is_healthy:
+                self.connect()
+            return self._sftp
+
+    def open_channel(self) -> "paramiko.SFTPClient":
+        """Opens an extra SFTP channel on the shared transport"""
+        with self._lock:
+            if not self.is_healthy:
+                self.connect()
+            import paramiko
+
+            channel = paramiko.SFTPClient.from_transport(self._client.get_transport())
+        channel.chdir(self.base_folder)
+        return channel
+
+    def ensure_folder(self, exp_folder, sftp: "paramiko.SFTPClient" = None):
+        if exp_folder in self._known_folders:
+            return
+        with self._lock:
+            if exp_folder in self._known_folders:
+                return
+            sftp = self.sftp if sftp is None else sftp
+            try:
+                sftp.stat(exp_folder)
+            except FileNotFoundError:
+                logger.info(f"Creating {exp_folder} folder")
+                sftp.mkdir(exp_folder)
+            self._known_folders.add(exp_folder)
+
+    def remote_sha256(self, remote_path, sftp: "paramiko.SFTPClient" = None):
+        """Asks the server for the sha256 of remote_path, None if it can't tell
+
+        The SFTP check-file extension is tried first, then sha256sum over an
+        exec channel. A method the server does not support is not tried again,
+        other errors only skip it for this file.
+        """
+        import paramiko
+
+        sftp = self.sftp if sftp is None else sftp
+        if "check-file" not in self._hash_failures:
+            try:
+                with sftp.open(remote_path, "rb") as f:
+                    return f.check("sha256", 0, 0, 0).hex()
+            except IOError as e:
+                if "unsupported" in str(e).lower():
+                    self._hash_failures.add("check-file")
+                else:
+                    logger.warning(f"check-file failed because {repr(e)}")
+        if "sha256sum" not in self._hash_failures:
+            try:
+                _, stdout, _ = self._client.exec_command(
+                    "sha256sum "
+                    + shlex.quote("/".join([self.base_folder, remote_path])),
+                    timeout=60,
+                )
+                output = stdout.read().decode("utf-8")
+                status = stdout.channel.recv_exit_status()
+            except paramiko.ChannelException:
+                # Exec channels refused by the server
+                self._hash_failures.add("sha256sum")
+            except Exception as e:
+                logger.warning(f"sha256sum failed because {repr(e)}")
+            else:
+                if status == 127:
+                    self._hash_failures.add("sha256sum")
+                elif status == 0 and output:
+                    return output.split()[0]
+                else:
+                    logger.warning(f"sha256sum exited with status {status}")
+        return None
+
+    def forget_folder(self, exp_folder):
+        self._known_folders.discard(exp_folder)
+
+    def close(self):
+        with self._lock:
+            for item in (self._sftp, self._client):
+                if item is not None:
+                    try:
+                        item.close()
+                    except Exception:
+                        pass
+            self._sftp = None
+            self._client = None
+            self._known_folders = set()
+
+
+_shared_session = None
+
+
+def get_sftp_session() -> SftpSession:
+    global _shared_session
+    if _shared_session is None:
+        _shared_session = SftpSession()
+    return _shared_session
+
+
+def record_upload(src_file_name, state, folder):
+    """Upload state changes never stop the file transfer itself"""
+    try:
+        get_catalogue().set_upload_state(src_file_name, state=state, folder=folder)
+    except Exception as e:
+        logger.error(
+            f"Unable to catalogue {src_file_name} as {state} because {repr(e)}"
+        )
+
+
+def open_journal() -> UploadJournal:
+    """Opens the upload journal and queues the catalogued images it does not hold"""
+    journal = get_journal()
+    added = journal.sync(get_catalogue().pending())
+    if added:
+        logger.info(f"{added} catalogued images added to the upload journal")
+    return journal
+
+
+def send_journal_item(journal: UploadJournal, src_file_name, src_folder, send) -> bool:
+    """Sends a dequeued item with send(path) and records the outcome
+
+    Failed items are retried after a backoff, files that are gone are marked
+    missing in the catalogue and leave the journal.
+    """
+    source_path = os.path.join(src_folder, src_file_name)
+    if not os.path.isfile(source_path):
+        logger.warning(f"{src_file_name} is not in {src_folder} anymore")
+        record_upload(src_file_name, state=UPLOAD_MISSING, folder=None)
+        journal.complete(src_file_name)
+        return False
+    error = ""
+    try:
+        ok = send(source_path)
+    except Exception as e:
+        logger.error(f"Unable to send {src_file_name} because {repr(e)}")
+        ok, error = False, repr(e)
+    if ok:
+        journal.complete(src_file_name)
+    else:
+        journal.fail(src_file_name, error=error)
+    return ok
+
+
+def dequeue_fitting(journal: UploadJournal, src_folder, deadline, force=False):
+    """Dequeues the oldest ready item if it can be sent before deadline at the
+    estimated upload speed
+
+    Returns None, leaving the item first in the queue, if it does not fit or
+    the deadline is reached. force lets the item through as long as the
+    deadline is not reached, so that a window always sends something.
+    """
+    estimate = get_throughput_estimate()
+
+    def fits(src_file_name):
+        if timer() >= deadline:
+            return False
+        if force:
+            return True
+        source_path = os.path.join(src_folder, src_file_name)
+        size = os.path.getsize(source_path) if os.path.isfile(source_path) else 0
+        return timer() + estimate.seconds_for(size) <= deadline
+
+    return journal.dequeue(accept=fits)
+
+
+def upload_file(ftp: "paramiko.SFTPClient", source_path, remote_path):
+    """Uploads source_path in chunks, continuing after any partial remote copy
+
+    The sha256 of the local file is computed during the single read of the
+    file, including the part already on the server that is not sent again.
+    Returns the remote size and the local hash. The transfer alone updates the
+    throughput estimate.
+    """
+    local_size = os.path.getsize(source_path)
+    try:
+        offset = ftp.stat(remote_path).st_size
+    except FileNotFoundError:
+        offset = 0
+    if offset > local_size:
+        offset = 0
+    digest = hashlib.sha256()
+    with open(source_path, "rb") as src:
+        remaining = offset
+        while remaining > 0:
+            chunk = src.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+        if offset > 0:
+            logger.info(f"Resuming {os.path.basename(source_path)} at {offset} bytes")
+        start = timer()
+        with ftp.open(remote_path, "r+b" if offset > 0 else "wb") as dst:
+            dst.seek(offset)
+            dst.set_pipelined(True)
+            while True:
+                chunk = src.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                dst.write(chunk)
+    get_throughput_estimate().add(size=local_size - offset, seconds=timer() - start)
+    return ftp.stat(remote_path).st_size, digest.hexdigest()
+
+
+def upload_to_server(source_path, session: SftpSession, sftp=None) -> bool:
+    src_file_name = os.path.basename(source_path)
+    exp_folder = src_file_name.split("#")[1]
+    remote_path = "/".join([exp_folder, src_file_name])
+    for attempt in range(2):
+        ftp = session.sftp if sftp is None else sftp
+        try:
+            session.ensure_folder(exp_folder, sftp=ftp)
+            remote_size, local_hash = upload_file(
+                ftp=ftp, source_path=source_path, remote_path=remote_path
+            )
+            # Check file size and content before moving the source
+            if os.path.getsize(source_path) != remote_size:
+                logger.error(f"Wrong destination file size: {src_file_name}")
+                return False
+            remote_hash = session.remote_sha256(remote_path=remote_path, sftp=ftp)
+            if remote_hash is None:
+                logger.warning(
+                    f"No remote checksum, {src_file_name} only verified by size"
+                )
+            elif remote_hash != local_hash:
+                logger.error(f"Wrong destination checksum, discarding: {src_file_name}")
+                ftp.remove(remote_path)
+                return False
+        except Exception as e:
+            session.forget_folder(exp_folder)
+            if attempt == 0 and sftp is None and not session.is_healthy:
+                logger.warning(f"Connection lost while sending {src_file_name}")
+                continue
+            logger.error(f"Unable to move {src_file_name} because {repr(e)}")
+            return False
+        break
+    logger.info(f"Moved {src_file_name}, moved source to sent folder")
+    shutil.move(source_path, source_path.replace("to_send", "sent"))
+    record_upload(src_file_name, state=UPLOAD_SENT, folder="sent")
+    return True
+
+
+def move_to_usb(source_path, base_target_folder) -> bool:
+    src_file_name = os.path.basename(source_path)
+    try:
+        target_folder = os.path.join(base_target_folder, src_file_name.split("#")[1])
+        if not os.path.exists(target_folder):
+            os.makedirs(target_folder)
+        shutil.move(
+            source_path,
+            os.path.join(target_folder, src_file_name),
+        )
+    except Exception as e:
+        logger.error(f"Unable to move {src_file_name} because {repr(e)}")
+        return False
+    else:
+        logger.info(f"Moved {src_file_name}")
+        record_upload(src_file_name, state=UPLOAD_USB, folder="usb")
+        return True
+
+
+def send_image(source_path, session: SftpSession = None) -> bool:
+    """Sends an image to the server or to the USB key, returns True on success"""
+    if server_conf:
+        try:
+            return upload_to_server(
+                source_path=source_path,
+                session=get_sftp_session() if session is None else session,
+            )
+        except Exception as e:
+            logger.error(
+                f"Unable to move {os.path.basename(source_path)} because {repr(e)}"
+            )
+            return False
+    else:
+        base_target_folder = find_usb_target_folder()
+        if not base_target_folder:
+            return False
+        return move_to_usb(
+            source_path=source_path, base_target_folder=base_target_folder
+        )
+
+
+def send_in_parallel(
+    journal: UploadJournal,
+    src_folder,
+    session: SftpSession,
+    concurrency: int,
+    deadline,
+):
+    """Sends the journal items over concurrency SFTP channels sharing the session
+    transport, each channel takes the next ready item when done with the last
+
+    Channels stop at the first item that can't be sent before deadline.
+    """
+    results = {True: 0, False: 0}
+    results_lock = threading.Lock()
+
+    def work():
+        ftp = None
+        src_file_name = None
+        try:
+            while timer() < deadline:
+                with results_lock:
+                    force = results[True] + results[False] == 0
+                src_file_name = dequeue_fitting(
+                    journal, src_folder, deadline, force=force
+                )
+                if src_file_name is None:
+                    return
+                if ftp is None:
+                    try:
+                        ftp = session.open_channel()
+                    except Exception as e:
+                        logger.error(f"Unable to open SFTP channel because {repr(e)}")
+                        return
+                ok = send_journal_item(
+                    journal,
+                    src_file_name,
+                    src_folder,
+                    lambda path: upload_to_server(
+                        source_path=path, session=session, sftp=ftp
+                    ),
+                )
+                src_file_name = None
+                with results_lock:
+                    results[ok] += 1
+                if not ok and not session.is_healthy:
+                    # Next file will open a channel on a fresh transport
+                    try:
+                        ftp.close()
+                    except Exception:
+                        pass
+                    ftp = None
+        finally:
+            if src_file_name is not None:
+                # Not sent, back in the queue for the next window
+                journal.release(src_file_name)
+            if ftp is not None:
+                try:
+                    ftp.close()
+                except Exception:
+                    pass
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(work) for _ in range(concurrency)]
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Upload channel stopped because {repr(e)}")
+    logger.info(
+        f"Sent {results[True]} of {results[True] + results[False]} images"
+        f" over {concurrency} channels"
+    )
+
+
+def send_pending_images(work_seconds: float, concurrency: int = 1):
+    """Sends the images of the upload journal, oldest first, that can be sent
+    within work_seconds at the estimated upload speed
+
+    Items that failed are skipped until their retry time and sending stops at
+    the first item too long for the time left, so that the time is spent on
+    files that can be sent.
+    """
+    start = timer()
+    src_folder = os.path.join(images_folder, "to_send", "")
+    if server_conf:
+        session = get_sftp_session()
+        send = lambda path: send_image(source_path=path, session=session)
+    else:
+        session = None
+        base_target_folder = find_usb_target_folder()
+        if not base_target_folder:
+            return
+        send = lambda path: move_to_usb(
+            source_path=path, base_target_folder=base_target_folder
+        )
+    try:
+        journal = open_journal()
+    except JournalBusy as e:
+        logger.warning(f"Not sending images, {e}")
+        return
+    if session is not None and concurrency > 1:
+        send_in_parallel(
+            journal=journal,
+            src_folder=src_folder,
+            session=session,
+            concurrency=concurrency,
+            deadline=start + work_seconds,
+        )
+    else:
+        tried = 0
+        while True:
+            if session is not None:
+                src_file_name = dequeue_fitting(
+                    journal, src_folder, start + work_seconds, force=tried == 0
+                )
+            elif timer() - start < work_seconds:
+                # Moves to the USB key are not limited by the link speed
+                src_file_name = journal.dequeue()
+            else:
+                src_file_name = None
+            if src_file_name is None:
+                break
+            send_journal_item(journal, src_file_name, src_folder, send)
+            tried += 1
+    left = journal.ready_count
+    if left:
+        logger.info(
+            f"Stopping sending images to avoid job conflicts after {(timer() - start) / 60} minutes,"
+            f" {left} images left for the next window"
+        )
+    else:
+        logger.info("Ended file sending")
+    failed = journal.failed()
+    if failed:
+        logger.info(f"{len(failed)} images waiting to be retried")
+
+
+class UploadWorker:
+    """Sends images from its own thread so that nobody waits on the network
+
+    Images go through the upload journal, so the ones not sent when the UI
+    closes are sent when start() is called on the next run, and failed ones
+    are retried after a backoff. Status messages are reported through the last callback given,
+    dispatch is used to bring them back to the thread that owns the UI. While
+    is_busy() is True they are only logged, so that they don't replace the
+    status of a running job.
+    """
+
+    def __init__(self, dispatch=None, is_busy=None) -> None:
+        self._thread = None
+        self._dispatch = dispatch
+        self._is_busy = is_busy
+        self._callback = None
+        self._journal = None
+        self._journal_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self.sent_count = 0
+        self.failed_count = 0
+
+    @property
+    def journal(self) -> UploadJournal:
+        with self._journal_lock:
+            if self._journal is None:
+                self._journal = open_journal()
+            return self._journal
+
+    def start(self, callback=None):
+        """Starts the thread, it opens the journal and sends what was left by
+        the previous sessions"""
+        if callback is not None:
+            self._callback = callback
+        if self._thread is None or not self._thread.is_alive():
+            self._idle.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="upload_worker", daemon=True
+            )
+            self._thread.start()
+
+    def enqueue(self, source_path, callback=None):
+        try:
+            journal = self.journal
+        except JournalBusy as e:
+            # Still pending in the catalogue, the owner of the journal sends it
+            logger.warning(f"Not sending {os.path.basename(source_path)}, {e}")
+            return
+        self._idle.clear()
+        journal.add(os.path.basename(source_path))
+        self.start(callback=callback)
+        self._wake.set()
+
+    @property
+    def pending(self) -> int:
+        return 0 if self._journal is None else len(self._journal)
+
+    def join(self):
+        """Waits until no image is ready, the ones waiting for a retry excepted"""
+        self._idle.wait()
+
+    def _report(self, message, wipe_after, log_level):
+        callback = self._callback
+        if callback is None:
+            return
+        if self._is_busy is not None and self._is_busy():
+            logger.log(log_level, message)
+            return
+        if self._dispatch is not None:
+            self._dispatch(
+                callback, message, wipe_after=wipe_after, log_level=log_level
+            )
+        else:
+            callback(message, wipe_after=wipe_after, log_level=log_level)
+
+    def _run(self):
+        src_folder = os.path.join(images_folder, "to_send", "")
+        try:
+            self.journal
+        except JournalBusy as e:
+            logger.warning(f"Upload worker not started, {e}")
+            self._idle.set()
+            return
+        except Exception as e:
+            logger.error(f"Upload worker not started because {repr(e)}")
+            self._idle.set()
+            return
+        while True:
+            self._wake.clear()
+            src_file_name = self.journal.dequeue()
+            if src_file_name is None:
+                self._idle.set()
+                self._wake.wait(timeout=self.journal.next_retry_in())
+                continue
+            ok = send_journal_item(
+                self.journal,
+                src_file_name,
+                src_folder,
+                lambda path: send_image(source_path=path),
+            )
+            if ok:
+                self.sent_count += 1
+                if self.journal.ready_count == 0:
+                    self._report(
+                        f"Upload queue empty, {self.sent_count} images sent",
+                        wipe_after=5,
+                        log_level=logging.INFO,
+                    )
+            else:
+                self.failed_count += 1
+                self._report(
+                    f"Failed to send {src_file_name}, {self.pending} images waiting",
+                    wipe_after=-1,
+                    log_level=logging.ERROR,
+                )